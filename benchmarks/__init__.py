@@ -0,0 +1,5 @@
+"""Benchmarks for the CSV pipelines of telegram_parking_bot/csvconv.py and
+csv_file_processor/nvr_export_list_processor.py.
+
+Run with ``python -m benchmarks`` from the repository root, see readme.md.
+"""
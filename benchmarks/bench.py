@@ -0,0 +1,251 @@
+"""Time the CSV pipelines on synthetic data and compare the results with a baseline.
+
+Cases:
+    interval_engine    IntervalEngine.update and csvconv.month_intervals_report on
+                       one month of stored camera events, from an empty engine
+    monthly_build      csvconv.main on a folder of camera exports, without the mail
+                       sync and Google Sheets steps (parse, event store, data_
+                       and intervals_ files of every month, from scratch)
+    format_datetime    nvr_export_list_processor.format_datetime on an NVR list
+    process_csv        nvr_export_list_processor.process_csv on an NVR list file
+
+Every case is run `repeat` times and the fastest time is kept. Peak memory is
+measured with tracemalloc in one extra run, so it covers allocations made by Python,
+numpy and pandas in this process but not in csvconv's worker processes.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+from benchmarks import generators
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+SCALES = {
+    'small': {'camera_rows': 10_000, 'plates': 200, 'days': 31, 'nvr_rows': 10_000},
+    'medium': {'camera_rows': 100_000, 'plates': 2_000, 'days': 62, 'nvr_rows': 100_000},
+    'large': {'camera_rows': 1_000_000, 'plates': 20_000, 'days': 92, 'nvr_rows': 500_000},
+}
+TOLERANCE = 0.2  # Allowed slowdown or memory growth against the baseline
+MIN_DELTA_SECONDS = 0.01  # Differences below this are timer noise
+
+def load_modules(workdir):
+    """Import csvconv and nvr_export_list_processor. csvconv creates its folders in the
+    current directory on import, so it is imported from inside `workdir`."""
+    for folder in ('telegram_parking_bot', 'csv_file_processor'):
+        path = os.path.join(ROOT, folder)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    os.chdir(workdir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import csvconv
+        import nvr_export_list_processor
+    return csvconv, nvr_export_list_processor
+
+def reset_workdir(workdir, keep=('csvdata',)):
+    """Remove everything csvconv produced so the next run starts from scratch"""
+    for name in os.listdir(workdir):
+        if name in keep:
+            continue
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    os.makedirs(os.path.join(workdir, 'csvbymonth'), exist_ok=True)
+
+def setup_interval_engine(params, workdir, csvconv, nvr):
+    df = generators.camera_events(params['camera_rows'], plates=params['plates'], days=31)
+    df = df[df['Номерной знак'] != 'Не лицензировано'].reset_index(drop=True)
+    # The columns of the frames read by csvconv
+    df['Белый список'] = 'Нет'
+    df['ТС спереди или сзади'] = 'Спереди'
+    df[csvconv.SOURCE_COLUMN] = 'events.CSV'
+    reset_workdir(workdir)
+    store = csvconv.EventStore(os.path.join(workdir, 'interval_engine.db'))
+    store.replace_files('2024-01', [], [df])
+    reconciler = csvconv.PlateReconciler({}, csvconv.PLATE_MAX_DISTANCE, csvconv.PLATE_MIN_READS)
+    engine = csvconv.IntervalEngine(store, reconciler, csvconv.VISIT_MAX_DAYS)
+
+    def run():
+        engine.reset()
+        engine.update()
+        csvconv.month_intervals_report(engine, '2024-01')
+    return run, len(df)
+
+def setup_monthly_build(params, workdir, csvconv, nvr):
+    generators.write_camera_exports(os.path.join(workdir, 'csvdata'), params['camera_rows'],
+                                    plates=params['plates'], days=params['days'])
+
+    def run():
+        reset_workdir(workdir)
+        sync_mailboxes, publish = csvconv.sync_mailboxes, csvconv.update_sheets_with_intervals
+        csvconv.sync_mailboxes = lambda accounts: None
+        csvconv.update_sheets_with_intervals = lambda months=None: set()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                csvconv.main()
+        finally:
+            csvconv.sync_mailboxes, csvconv.update_sheets_with_intervals = sync_mailboxes, publish
+    return run, params['camera_rows']
+
+def setup_format_datetime(params, workdir, csvconv, nvr):
+    path = generators.write_nvr_export(os.path.join(workdir, 'nvr_format.csv'), params['nvr_rows'])
+    df = pd.read_csv(path, encoding='utf-8-sig')
+    return (lambda: nvr.format_datetime(df.copy())), len(df)
+
+def setup_process_csv(params, workdir, csvconv, nvr):
+    path = generators.write_nvr_export(os.path.join(workdir, 'nvr_export.csv'), params['nvr_rows'])
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            nvr.process_csv(path, additional_df=None)
+    return run, params['nvr_rows']
+
+CASES = {
+    'interval_engine': setup_interval_engine,
+    'monthly_build': setup_monthly_build,
+    'format_datetime': setup_format_datetime,
+    'process_csv': setup_process_csv,
+}
+
+def measure(run, repeat):
+    """Return the fastest of `repeat` runs in seconds and the peak traced memory in MB"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / (1024 * 1024)
+
+def run_benchmarks(scales, cases, repeat=3):
+    """Run the cases at the given scales, returns {"scale/case": result}"""
+    results = {}
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='btc-bench-')
+    try:
+        csvconv, nvr = load_modules(workdir)
+        for scale in scales:
+            for case in cases:
+                reset_workdir(workdir, keep=())
+                run, rows = CASES[case](SCALES[scale], workdir, csvconv, nvr)
+                seconds, peak_mb = measure(run, repeat)
+                results[f'{scale}/{case}'] = {'rows': rows, 'seconds': round(seconds, 4),
+                                              'peak_mb': round(peak_mb, 1)}
+                print(f"{scale:<7} {case:<18} {rows:>10} rows {seconds:9.3f}s {peak_mb:9.1f} MB", flush=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def environment():
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def load_results(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_results(path, data):
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, path)
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Print the change against the baseline for every result.
+    Returns the keys that got slower or use more memory than allowed."""
+    regressions = []
+    print("\nAgainst baseline:")
+    for key, result in results.items():
+        base = baseline['results'].get(key)
+        if not base:
+            print(f"{key:<26} no baseline")
+            continue
+        if base['rows'] != result['rows']:
+            print(f"{key:<26} baseline has {base['rows']} rows, skipped")
+            continue
+        time_change = result['seconds'] / base['seconds'] - 1 if base['seconds'] else 0.0
+        memory_change = result['peak_mb'] / base['peak_mb'] - 1 if base['peak_mb'] else 0.0
+        slower = (time_change > tolerance
+                  and result['seconds'] - base['seconds'] > MIN_DELTA_SECONDS)
+        bigger = memory_change > tolerance
+        flag = "  REGRESSION" if slower or bigger else ""
+        print(f"{key:<26} time {time_change:+7.1%}  memory {memory_change:+7.1%}{flag}")
+        if slower or bigger:
+            regressions.append(key)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description="Benchmark the CSV pipelines on synthetic data")
+    parser.add_argument('--scale', nargs='+', choices=list(SCALES), default=['small', 'medium'],
+                        help="data sizes to run (default: small medium)")
+    parser.add_argument('--case', nargs='+', choices=list(CASES), default=list(CASES),
+                        help="cases to run (default: all)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per case (default: 3)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help="baseline file (default: benchmarks/baseline.json)")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results in the baseline file instead of comparing")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="allowed slowdown or memory growth, 0.2 = 20%% (default)")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scale, args.case, repeat=max(1, args.repeat))
+    data = {**environment(), 'results': results}
+    if args.output:
+        save_results(args.output, data)
+
+    if args.save_baseline:
+        # Keep the baseline of cases that were not run this time
+        previous = load_results(args.baseline)
+        if previous:
+            data['results'] = {**previous['results'], **results}
+        save_results(args.baseline, data)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    baseline = load_results(args.baseline)
+    if baseline is None:
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+    if baseline.get('platform') != data['platform'] or baseline.get('cpu_count') != data['cpu_count']:
+        print(f"\nNote: the baseline was recorded on {baseline.get('platform')} "
+              f"with {baseline.get('cpu_count')} CPUs")
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    print("\nNo regressions")
+    return 0
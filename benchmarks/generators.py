@@ -0,0 +1,122 @@
+"""Synthetic inputs for the benchmarks.
+
+Camera exports look like the files csvconv downloads from the NVR mails: one file
+per camera (CH01 entry camera 192.168.4.103, CH02 exit camera 192.168.4.104) and
+day, with the snapshot time, plate and a few columns csvconv does not read. NVR
+export lists look like the lists cleaned by nvr_export_list_processor: Cyrillic
+plates, notes in parentheses, empty values, duplicates and DD-MM-YY HH:MM dates.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+ENTRY_CAMERA = '192.168.4.103'  # CH01
+EXIT_CAMERA = '192.168.4.104'   # CH02
+
+LATIN_LETTERS = list('ABEHKMOPCTX')
+CYRILLIC_LETTERS = list('АВЕНКМОРСТХ')
+
+def make_plates(count, letters=LATIN_LETTERS, seed=0):
+    """Return `count` distinct plates like 1234AB-7"""
+    rng = np.random.default_rng(seed)
+    plates = set()
+    while len(plates) < count:
+        digits = rng.integers(1000, 10000, count)
+        first = rng.choice(letters, count)
+        second = rng.choice(letters, count)
+        region = rng.integers(1, 8, count)
+        plates.update(f'{d}{a}{b}-{r}' for d, a, b, r in zip(digits, first, second, region))
+    return sorted(plates)[:count]
+
+def camera_events(rows, plates=500, start='2024-01-01', days=31, unlicensed=0.02, seed=0):
+    """Generate about `rows` camera events as a DataFrame.
+
+    Every visit is a CH01 snapshot at entry and a CH02 snapshot at exit, from a few
+    minutes to a few days later. Some snapshots are repeated (a car standing in front
+    of the camera) and a share of them has the plate 'Не лицензировано'.
+    Columns: 'Канал', 'Номерной знак', 'Время мом. снимка'
+    """
+    rng = np.random.default_rng(seed)
+    plate_names = np.array(make_plates(plates, seed=seed), dtype=object)
+    visits = max(1, rows // 2)
+    start = pd.Timestamp(start)
+    span = days * 86400
+
+    plate = rng.choice(plate_names, visits)
+    entry = rng.integers(0, span, visits)
+    # Most visits are short, a few last for days
+    stay = np.minimum(rng.lognormal(np.log(3600), 1.5, visits).astype(np.int64) + 60, 7 * 86400)
+    exit_ = entry + stay
+    # Visits must end inside the period so every file belongs to a generated day
+    exit_ = np.where(exit_ < span, exit_, entry + (span - entry) // 2)
+
+    channel = np.r_[np.full(visits, 'CH01', dtype=object), np.full(visits, 'CH02', dtype=object)]
+    plates_col = np.r_[plate, plate]
+    seconds = np.r_[entry, exit_]
+
+    # Repeated snapshots of the same car a few seconds later
+    repeat = rng.random(len(seconds)) < 0.05
+    channel = np.r_[channel, channel[repeat]]
+    plates_col = np.r_[plates_col, plates_col[repeat]]
+    seconds = np.r_[seconds, np.minimum(seconds[repeat] + rng.integers(1, 30, repeat.sum()), span - 1)]
+
+    plates_col = np.where(rng.random(len(plates_col)) < unlicensed, 'Не лицензировано', plates_col)
+
+    df = pd.DataFrame({
+        'Канал': channel,
+        'Номерной знак': plates_col,
+        'Время мом. снимка': start + pd.to_timedelta(seconds, unit='s'),
+    })
+    return df.sort_values('Время мом. снимка', kind='stable').reset_index(drop=True)
+
+def write_camera_exports(directory, rows, plates=500, start='2024-01-01', days=31, seed=0):
+    """Write camera exports for csvconv into `directory`, one file per camera and day
+    named like 192.168.4.103_2024-01-05.CSV. Returns the file names."""
+    os.makedirs(directory, exist_ok=True)
+    df = camera_events(rows, plates=plates, start=start, days=days, seed=seed)
+    rng = np.random.default_rng(seed + 1)
+    df['Белый список'] = np.where(rng.random(len(df)) < 0.1, 'Да', 'Нет')
+    df['ТС спереди или сзади'] = np.where(rng.random(len(df)) < 0.8, 'Спереди', 'Сзади')
+    df['Уверенность'] = rng.integers(60, 100, len(df))
+    df['day'] = df['Время мом. снимка'].dt.strftime('%Y-%m-%d')
+    df['Время мом. снимка'] = df['Время мом. снимка'].dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    files = []
+    for (channel, day), group in df.groupby(['Канал', 'day'], sort=True):
+        camera = ENTRY_CAMERA if channel == 'CH01' else EXIT_CAMERA
+        name = f'{camera}_{day}.CSV'
+        group = group.drop(columns=['Канал', 'day'])
+        group.insert(0, '№', range(1, len(group) + 1))
+        group.to_csv(os.path.join(directory, name), index=False, encoding='utf-8')
+        files.append(name)
+    return files
+
+def nvr_export(rows, unique=None, notes=0.1, empty=0.02, seed=0):
+    """Generate an NVR export list as a DataFrame.
+
+    The first column holds Cyrillic plates, some with a note in parentheses or
+    surrounding punctuation. `unique` plates (rows // 3 by default) are drawn with
+    repetition, so most of them appear several times.
+    """
+    rng = np.random.default_rng(seed)
+    unique = unique or max(1, rows // 3)
+    plates = np.array(make_plates(unique, letters=CYRILLIC_LETTERS, seed=seed), dtype=object)
+    values = rng.choice(plates, rows)
+
+    noted = rng.random(rows) < notes
+    values[noted] = values[noted] + rng.choice([' (гость)', ' (аренда)', ' (до 31.12)', '.'], noted.sum())
+    values[rng.random(rows) < empty] = None
+
+    times = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365 * 86400, rows), unit='s')
+    return pd.DataFrame({
+        'Номер': values,
+        'Начало': times.strftime('%d-%m-%y %H:%M'),
+        'Окончание': (times + pd.Timedelta(days=30)).strftime('%d-%m-%y %H:%M'),
+        'Владелец': rng.choice(['ООО "Ромашка"', 'Иванов И.И.', 'Склад, ворота 2', ''], rows),
+        'Группа': rng.integers(1, 10, rows),
+    })
+
+def write_nvr_export(path, rows, unique=None, seed=0):
+    """Write an NVR export list for nvr_export_list_processor to `path`"""
+    nvr_export(rows, unique=unique, seed=seed).to_csv(path, index=False, encoding='utf-8-sig')
+    return path
@@ -1,43 +1,68 @@
 # Import required libraries
 import pandas as pd  # For data manipulation and analysis
 import csv          # For CSV file operations
-import re           # For regular expression operations
 import os           # For file path operations
+import numpy as np  # For the row index in streaming mode
+import sys          # For the exit code
+import io           # For capturing the report of each file
+import time         # For the timing summary
+import argparse     # For command line arguments
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime  # For datetime operations
 
-def russian_to_latin(text):
+# Files larger than this are processed in streaming mode with bounded memory
+STREAMING_THRESHOLD_MB = int(os.getenv('NVR_STREAMING_THRESHOLD_MB', '200'))
+STREAM_CHUNK_ROWS = 100000  # Rows per chunk in streaming mode
+
+# Translation table from Russian characters to their Latin lookalikes
+RUS_TO_LAT = str.maketrans({
+    'А': 'A', 'В': 'B', 'Е': 'E', 'К': 'K', 'М': 'M', 'Н': 'H',
+    'О': 'O', 'Р': 'P', 'С': 'C', 'Т': 'T', 'У': 'Y', 'Х': 'X',
+    'а': 'a', 'в': 'b', 'е': 'e', 'к': 'k', 'м': 'm', 'н': 'h',
+    'о': 'o', 'р': 'p', 'с': 'c', 'т': 't', 'у': 'y', 'х': 'x'
+})
+
+DATETIME_PATTERN = r'\d{2}-\d{2}-\d{2}\s+\d{1,2}:\d{2}'
+DATETIME_SAMPLE_ROWS = 100  # Rows inspected when detecting datetime columns
+
+# Key used for empty first-column values, which drop_duplicates treats as equal
+_MISSING = object()
+# Default of process_csv: read addnumbers.csv from the script directory
+_LOAD = object()
+
+def process_values(series):
     """
-    Convert Russian characters to their Latin lookalikes
+    Process a whole column: handle NaN, remove parentheses and special characters,
+    and convert Russian characters to Latin
     Args:
-        text: Input string containing Russian characters
+        series: Input Series
     Returns:
-        String with Russian characters replaced by Latin equivalents
+        Series of processed string values
     """
-    rus_to_lat = {
-        'А': 'A', 'В': 'B', 'Е': 'E', 'К': 'K', 'М': 'M', 'Н': 'H',
-        'О': 'O', 'Р': 'P', 'С': 'C', 'Т': 'T', 'У': 'Y', 'Х': 'X',
-        'а': 'a', 'в': 'b', 'е': 'e', 'к': 'k', 'м': 'm', 'н': 'h',
-        'о': 'o', 'р': 'p', 'с': 'c', 'т': 't', 'у': 'y', 'х': 'x'
-    }
-    # Replace each character if it exists in mapping, otherwise keep original
-    return ''.join(rus_to_lat.get(char, char) for char in str(text))
+    # Work on Python strings so that \w matches Cyrillic letters like re does
+    values = series.where(series.notna(), '').astype(str).astype(object)
+    values = values.str.replace(r'\([^)]*\)', '', regex=True)  # Remove content within parentheses
+    values = values.str.replace(r'[^\w]', '', regex=True)      # Remove non-word characters
+    return values.str.translate(RUS_TO_LAT)                    # Convert Russian to Latin characters
 
-def process_value(value):
+def find_datetime_columns(df):
     """
-    Process a single value: handle NaN, remove parentheses and special characters,
-    and convert Russian characters to Latin
+    Find columns that contain DD-MM-YY HH:MM datetime strings
     Args:
-        value: Input value to process
+        df: Input DataFrame
     Returns:
-        Processed string value
+        List of column names
     """
-    if pd.isna(value):  # Check for NaN values
-        return ''
-    value = str(value)
-    value = re.sub(r'\([^)]*\)', '', value)  # Remove content within parentheses
-    value = re.sub(r'[^\w]', '', value)      # Remove non-word characters
-    value = russian_to_latin(value)          # Convert Russian to Latin characters
-    return value
+    columns = []
+    for col in df.columns:
+        # Check if the non-empty values of the first rows are all date-like
+        sample = df[col].head(DATETIME_SAMPLE_ROWS).dropna()
+        if sample.empty or not sample.map(lambda value: isinstance(value, str)).all():
+            continue
+        if sample.astype(object).str.contains(DATETIME_PATTERN, regex=True).all():
+            columns.append(col)
+    return columns
 
 def format_datetime(df):
     """
@@ -47,78 +72,57 @@ def format_datetime(df):
     Returns:
         DataFrame with formatted datetime columns
     """
-    for col in df.columns:
-        # Check if column contains date-like values
-        sample_value = df[col].iloc[0] if not df.empty else None
-        if isinstance(sample_value, str) and re.search(r'\d{2}-\d{2}-\d{2}\s+\d{1,2}:\d{2}', str(sample_value)):
-            try:
-                # Convert datetime format
-                df[col] = pd.to_datetime(df[col], format='%d-%m-%y %H:%M')
-                df[col] = df[col].dt.strftime('%Y-%m-%d %H:%M')
-            except:
-                continue
+    for col in find_datetime_columns(df):
+        try:
+            # Convert datetime format
+            df[col] = pd.to_datetime(df[col], format='%d-%m-%y %H:%M')
+            df[col] = df[col].dt.strftime('%Y-%m-%d %H:%M')
+        except:
+            continue
     return df
 
-def process_csv(input_file):
+def process_csv(input_file, additional_df=_LOAD):
     """
     Main function to process CSV file: handle duplicates, format dates,
-    and clean data
+    and clean data. Large files are handed over to process_csv_streaming
     Args:
         input_file: Path to input CSV file
+        additional_df: Rows of addnumbers.csv from read_additional_rows, or None
+            for no additional rows. Read from the script directory if not given
+    Returns:
+        Path of the processed file
     """
+    if additional_df is _LOAD:
+        additional_df = read_additional_rows()
+    if os.path.getsize(input_file) > STREAMING_THRESHOLD_MB * 1024 * 1024:
+        return process_csv_streaming(input_file, additional_df=additional_df)
+
     # Read CSV file with UTF-8 BOM encoding
     df = pd.read_csv(input_file, encoding='utf-8-sig')
     
     # Format datetime columns in the DataFrame
     df = format_datetime(df)
     
-    # Check for duplicates in first column before processing
+    # Count values of the first column in one pass, in order of first appearance
     first_col = df.columns[0]
-    duplicates = df[df.duplicated(subset=first_col, keep=False)]
-    
-    # Print duplicate information if found
-    if len(duplicates) > 0:
-        print("\nFound duplicates:")
-        for value in duplicates[first_col].unique():
-            if pd.notna(value):  # Only print non-empty values
-                print(f"'{value}' appears {len(duplicates[duplicates[first_col] == value])} times")
-        print(f"\nTotal duplicates found: {len(duplicates)}")
-    else:
-        print("No duplicates found")
+    counts = df[first_col].value_counts(sort=False, dropna=False)
+    counts = counts.reindex(pd.unique(df[first_col]))
+    print_duplicates({(_MISSING if pd.isna(value) else value): count for value, count in counts.items()},
+                     len(df))
     
     # Remove duplicates, keeping only the last occurrence
-    df_no_dupes = df.drop_duplicates(subset=first_col, keep='last')
-    
-    # Print summary of duplicate removal
-    print(f"\nRows before: {len(df)}")
-    print(f"Rows after: {len(df_no_dupes)}")
-    print(f"Removed {len(df) - len(df_no_dupes)} duplicate rows")
+    df_no_dupes = df.drop_duplicates(subset=first_col, keep='last').copy()
     
     # Process the first column in the deduplicated DataFrame
-    df_no_dupes[first_col] = df_no_dupes[first_col].apply(process_value)
-    
-    # Get the directory of the current script
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    additional_file = os.path.join(script_dir, 'addnumbers.csv')
+    df_no_dupes[first_col] = process_values(df_no_dupes[first_col])
     
     try:
-        # Read additional rows from addnumbers.csv
-        additional_df = pd.read_csv(additional_file, encoding='utf-8-sig')
-        
-        # Ensure additional_df has the same columns as main DataFrame
-        if list(additional_df.columns) != list(df_no_dupes.columns):
-            print("\nWarning: Columns in addnumbers.csv do not match the main file.")
-            print(f"Main file columns: {list(df_no_dupes.columns)}")
-            print(f"addnumbers.csv columns: {list(additional_df.columns)}")
-            raise ValueError("Column mismatch")
-        
-        # Concatenate the main DataFrame with additional rows
-        final_df = pd.concat([df_no_dupes, additional_df], ignore_index=True)
-        
-    except FileNotFoundError:
-        print("\nWarning: addnumbers.csv not found in script directory")
-        print(f"Expected path: {additional_file}")
-        final_df = df_no_dupes
+        # Append the additional rows from addnumbers.csv to the main DataFrame
+        if additional_df is None:
+            final_df = df_no_dupes
+        else:
+            check_additional_rows(additional_df, df_no_dupes.columns)
+            final_df = pd.concat([df_no_dupes, additional_df], ignore_index=True)
     except Exception as e:
         print(f"\nError processing addnumbers.csv: {str(e)}")
         final_df = df_no_dupes
@@ -133,7 +137,273 @@ def process_csv(input_file):
                     quoting=csv.QUOTE_ALL, lineterminator=',\n')
     
     print(f"\nProcessed file saved as: {output_file}")
+    return output_file
+
+def print_duplicates(counts, total_rows):
+    """
+    Print the duplicate report from occurrence counts of first-column values
+    Args:
+        counts: Dict of value -> number of rows, in order of first appearance
+        total_rows: Number of rows read
+    Returns:
+        Number of rows left after removing duplicates
+    """
+    duplicated = {value: count for value, count in counts.items() if count > 1}
+    if duplicated:
+        print("\nFound duplicates:")
+        for value, count in duplicated.items():
+            if value is not _MISSING:  # Only print non-empty values
+                print(f"'{value}' appears {count} times")
+        print(f"\nTotal duplicates found: {sum(duplicated.values())}")
+    else:
+        print("No duplicates found")
+
+    rows_after = len(counts)
+    print(f"\nRows before: {total_rows}")
+    print(f"Rows after: {rows_after}")
+    print(f"Removed {total_rows - rows_after} duplicate rows")
+    return rows_after
+
+def _first_column_keys(series):
+    return [_MISSING if pd.isna(value) else value for value in series]
+
+def process_csv_streaming(input_file, chunksize=STREAM_CHUNK_ROWS, additional_df=_LOAD):
+    """
+    Process a CSV file that does not fit in memory. Produces the same output as
+    process_csv, reading the file twice in chunks:
+    1. Count first-column values and remember the offset of the last row of each
+       value (the one kept by "keep last"), and find datetime columns
+    2. Re-read the file and write only the kept rows, chunk by chunk
+    Values are parsed as read_csv does for the whole file: a column with whole numbers
+    in some chunks and decimals or empty values in others is written as decimals
+    Args:
+        input_file: Path to input CSV file
+        chunksize: Number of rows read at a time
+        additional_df: Rows of addnumbers.csv, as in process_csv
+    Returns:
+        Path of the processed file, or None if the input file is empty
+    """
+    if additional_df is _LOAD:
+        additional_df = read_additional_rows()
+    print(f"\nLarge file, processing in chunks of {chunksize} rows")
+
+    def read_chunks():
+        return pd.read_csv(input_file, encoding='utf-8-sig', chunksize=chunksize)
+
+    # First pass: last row offset and count of every first-column value
+    last_row = {}
+    counts = {}
+    datetime_columns = None
+    columns = None
+    chunk_dtypes = {}  # Column -> dtypes it was parsed as in the chunks
+    offset = 0
+    for chunk in read_chunks():
+        if columns is None:
+            columns = list(chunk.columns)
+            datetime_columns = find_datetime_columns(chunk)
+        for col, dtype in chunk.dtypes.items():
+            chunk_dtypes.setdefault(col, set()).add(dtype.kind)
+        # A datetime column must convert in every chunk, otherwise it is kept as is
+        for col in list(datetime_columns):
+            try:
+                pd.to_datetime(chunk[col], format='%d-%m-%y %H:%M')
+            except (ValueError, TypeError):
+                datetime_columns.remove(col)
+        for position, key in enumerate(_first_column_keys(chunk[columns[0]]), start=offset):
+            last_row[key] = position
+            counts[key] = counts.get(key, 0) + 1
+        offset += len(chunk)
+
+    if columns is None:
+        print("Input file is empty")
+        return None
+    print_duplicates(counts, offset)
+    keep_rows = np.fromiter(last_row.values(), dtype=np.int64, count=len(last_row))
+    keep_rows.sort()
+    del last_row, counts
+    # Whole numbers in a column that has decimals elsewhere are read as decimals from the whole file
+    float_columns = [col for col, kinds in chunk_dtypes.items() if 'f' in kinds and kinds <= {'i', 'u', 'f'}]
+
+    try:
+        if additional_df is not None:
+            check_additional_rows(additional_df, columns)
+    except Exception as e:
+        print(f"\nError processing addnumbers.csv: {str(e)}")
+        additional_df = None
+
+    # Second pass: write the kept rows
+    base_name, ext = os.path.splitext(input_file)
+    output_file = f"{base_name}_modified{ext}"
+    offset = 0
+    start = 0
+    first = True
+    for chunk in read_chunks():
+        # keep_rows is sorted, so the kept rows of this chunk are one slice of it
+        rows = len(chunk)
+        end = int(np.searchsorted(keep_rows, offset + rows))
+        chunk = chunk.iloc[keep_rows[start:end] - offset].copy()
+        start = end
+        offset += rows
+        for col in float_columns:
+            chunk[col] = chunk[col].astype('float64')
+        for col in datetime_columns:
+            chunk[col] = pd.to_datetime(chunk[col], format='%d-%m-%y %H:%M').dt.strftime('%Y-%m-%d %H:%M')
+        chunk[columns[0]] = process_values(chunk[columns[0]])
+        chunk.to_csv(output_file, index=False, mode='w' if first else 'a', header=first,
+                     encoding='utf-8-sig' if first else 'utf-8',
+                     quoting=csv.QUOTE_ALL, lineterminator=',\n')
+        first = False
+
+    if additional_df is not None:
+        additional_df.to_csv(output_file, index=False, mode='a', header=False, encoding='utf-8',
+                             quoting=csv.QUOTE_ALL, lineterminator=',\n')
+
+    print(f"\nProcessed file saved as: {output_file}")
+    return output_file
+
+def read_additional_rows():
+    """
+    Read the rows of addnumbers.csv from the script directory
+    Returns:
+        DataFrame with the additional rows, or None if the file does not exist
+        or cannot be read
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    additional_file = os.path.join(script_dir, 'addnumbers.csv')
+    try:
+        return pd.read_csv(additional_file, encoding='utf-8-sig')
+    except FileNotFoundError:
+        print("\nWarning: addnumbers.csv not found in script directory")
+        print(f"Expected path: {additional_file}")
+    except Exception as e:
+        print(f"\nError processing addnumbers.csv: {str(e)}")
+    return None
+
+def check_additional_rows(additional_df, columns):
+    """
+    Ensure addnumbers.csv has the same columns as the main file
+    Args:
+        additional_df: DataFrame from read_additional_rows
+        columns: Columns of the main file
+    Raises:
+        ValueError: If the columns differ
+    """
+    if list(additional_df.columns) != list(columns):
+        print("\nWarning: Columns in addnumbers.csv do not match the main file.")
+        print(f"Main file columns: {list(columns)}")
+        print(f"addnumbers.csv columns: {list(additional_df.columns)}")
+        raise ValueError("Column mismatch")
+
+# Rows of addnumbers.csv in a worker process, set once by _init_worker
+_worker_additional_df = None
+
+def _init_worker(additional_df):
+    global _worker_additional_df
+    _worker_additional_df = additional_df
+
+def _process_file(input_file, additional_df=_LOAD):
+    """
+    Process one file for process_files, capturing its report
+    Returns:
+        Tuple (input_file, output_file, seconds, report, error)
+    """
+    if additional_df is _LOAD:
+        additional_df = _worker_additional_df
+    report = io.StringIO()
+    start = time.perf_counter()
+    output_file, error = None, None
+    with redirect_stdout(report):
+        try:
+            output_file = process_csv(input_file, additional_df=additional_df)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+    return input_file, output_file, time.perf_counter() - start, report.getvalue(), error
+
+def collect_input_files(paths):
+    """
+    Expand directories into the CSV files they contain. Processed files
+    (*_modified.csv) and addnumbers.csv are skipped
+    Args:
+        paths: File and directory paths
+    Returns:
+        List of file paths
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                stem, ext = os.path.splitext(name)
+                if (ext.lower() != '.csv' or stem.endswith('_modified')
+                        or name.lower() == 'addnumbers.csv'):
+                    continue
+                files.append(os.path.join(path, name))
+        else:
+            files.append(path)
+    return files
+
+def process_files(input_files, jobs=None):
+    """
+    Process many CSV files in parallel worker processes. addnumbers.csv is read
+    once and handed to the workers. The report of each file is printed when it
+    is done, followed by a timing summary
+    Args:
+        input_files: Paths of the CSV files
+        jobs: Number of worker processes (defaults to the number of CPU cores)
+    Returns:
+        List of (input_file, output_file, seconds, error) tuples
+    """
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(input_files) or 1))
+    additional_df = read_additional_rows()
+
+    results = []
+    def report(result):
+        input_file, output_file, seconds, text, error = result
+        print(f"\n=== {input_file} ===")
+        print(text, end='')
+        if error:
+            print(f"\nError processing {input_file}: {error}")
+        results.append((input_file, output_file, seconds, error))
+
+    start = time.perf_counter()
+    if jobs == 1:
+        for input_file in input_files:
+            report(_process_file(input_file, additional_df))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(additional_df,)) as executor:
+            for result in executor.map(_process_file, input_files):
+                report(result)
+    total = time.perf_counter() - start
+
+    print("\nSummary:")
+    width = max(len(input_file) for input_file, *_ in results) if results else 0
+    for input_file, output_file, seconds, error in results:
+        status = f"error: {error}" if error else (output_file or "empty file, nothing written")
+        print(f"{input_file:<{width}}  {seconds:8.2f}s  {status}")
+    failed = sum(1 for *_, error in results if error)
+    print(f"Processed {len(results) - failed} of {len(results)} files in {total:.2f}s with {jobs} worker(s)")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Deduplicate and clean NVR export lists. Each file is saved with a _modified suffix")
+    parser.add_argument('paths', nargs='*',
+                        help="CSV files or directories with CSV files (asks for a file name if omitted)")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of worker processes (default: number of CPU cores)")
+    args = parser.parse_args(argv)
+
+    if not args.paths:
+        input_file = input("Enter input CSV filename: ")  # Get input filename from user
+        process_csv(input_file)  # Process the CSV file
+        return 0
+
+    input_files = collect_input_files(args.paths)
+    if not input_files:
+        print("No CSV files found")
+        return 1
+    results = process_files(input_files, jobs=args.jobs)
+    return 1 if any(error for *_, error in results) else 0
 
-# Script execution
-input_file = input("Enter input CSV filename: ")  # Get input filename from user
-process_csv(input_file)  # Process the CSV file
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,32 @@
 # Import necessary libraries
 import os
-import telebot # type: ignore
+import asyncio
+import signal
+import inspect
+from telebot import asyncio_helper, types # type: ignore
+from telebot.async_telebot import AsyncTeleBot # type: ignore
 from dotenv import load_dotenv # type: ignore
 import logging
-import schedule # type: ignore
 import time
-from imap_tools import MailBox, A # type: ignore
+from imap_tools import MailBox, A, U # type: ignore
 from datetime import datetime, timedelta
 import sqlite3
 import threading
+import socket
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import re
+import io
+import hashlib
+import base64
+import quopri
+import email.header
+import urllib.parse
+from collections import namedtuple
+from contextlib import contextmanager
+import metrics
+import images
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,188 +37,1228 @@ EMAIL = os.getenv("EMAIL")
 PASSWORD = os.getenv("EMAIL_PASSWORD")
 TO_EMAIL = os.getenv("TOEMAIL")  # New variable for the specified email address
 
+# Mail watching settings
+SENT_FOLDER = '[Gmail]/Отправленные'
+MAIL_MODE = os.getenv("MAIL_MODE", "idle").lower()  # "idle" (push) or "poll"
+POLL_INTERVAL = 60  # Seconds between checks in polling mode
+IDLE_TIMEOUT = 10 * 60  # Re-issue IDLE well before the server's 29-minute limit
+# Socket timeout of the IMAP session, longer than an IDLE poll, so a half-open
+# connection fails and is re-established instead of blocking the session forever
+IMAP_TIMEOUT = IDLE_TIMEOUT + 60
+RECONNECT_DELAY_MIN = 5
+RECONNECT_DELAY_MAX = 300
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
 # Telegram bot settings
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ALLOWED_USERS = os.getenv("ALLOWED_USERS", "").split(",")
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))  # Parallel sends to subscribers
+GLOBAL_SEND_RATE = 25  # Messages per second over all chats (Telegram allows about 30)
+CHAT_SEND_INTERVAL = 1.0  # Seconds between messages to the same chat
+SEND_BATCH = 50  # Queued sends picked up at a time
+SEND_RETRY_MIN = 5  # Seconds before the first retry of a failed send, doubled on every further attempt
+SEND_RETRY_MAX = 3600
+SEND_MAX_ATTEMPTS = 12  # A send that keeps failing is dropped after this many attempts
+MEDIA_GROUP_SIZE = 10  # Photos per album, the most Telegram accepts in one send_media_group
+
+# Image upload settings. Telegram shows photos at most 2560 pixels wide, larger ones
+# are only slower to upload. The stored originals are never changed.
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "2560"))  # Longest side of uploaded photos in pixels
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))  # JPEG quality of re-encoded photos
+IMAGE_SHRINK_KB = int(os.getenv("IMAGE_SHRINK_KB", "1024"))  # Smaller images that fit IMAGE_MAX_SIDE are uploaded as they are
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))  # Processes that shrink images
+
+# Liveness settings
+HEARTBEAT_FILE = 'mail_bot.heartbeat'  # Touched while the bot is healthy, watched by monitor_bot_service.py
+HEARTBEAT_INTERVAL = 10  # Seconds between heartbeats
+POLL_STALE_AFTER = 120  # Polling counts as stuck if no getUpdates call returned for this long
+# The mail thread counts as stuck if it finished no check, IDLE cycle or reconnect attempt for this long
+MAIL_STALE_AFTER = (IDLE_TIMEOUT if MAIL_MODE == 'idle' else POLL_INTERVAL) + IMAP_TIMEOUT + 60
+SHUTDOWN_TIMEOUT = 10  # Seconds given to running tasks to finish on SIGTERM
 
-# Initialize Telegram bot
-bot = telebot.TeleBot(BOT_TOKEN)
+class HeartbeatBot(AsyncTeleBot):
+    """
+    AsyncTeleBot that remembers when getUpdates last returned, so that a hung
+    polling loop can be told apart from a quiet chat.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_poll = time.monotonic()
 
-# Configure logging
-logging.basicConfig(filename='mail_bot.log', level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    encoding='utf-8')
+    async def get_updates(self, *args, **kwargs):
+        updates = await super().get_updates(*args, **kwargs)
+        self.last_poll = time.monotonic()
+        return updates
 
-# Create folder for saving images
+# The bot, the database and the attachment store are created in main(). Importing
+# this module must not do any setup: the image worker processes import it again.
+bot = None
+db = None
+attachment_store = None
+
+# Folder for saving images
 PICTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Pictures")
-if not os.path.exists(PICTURES_FOLDER):
-    os.makedirs(PICTURES_FOLDER)
 
-# Initialize database
-def init_db():
+# Optional limits for the Pictures folder, unset means keep everything
+PICTURES_MAX_MB = os.getenv("PICTURES_MAX_MB")
+PICTURES_MAX_AGE_DAYS = os.getenv("PICTURES_MAX_AGE_DAYS")
+
+# Database settings
+DB_FILE = 'mail_bot.db'
+# Days processed email IDs are kept. Older emails are outside the IMAP search window
+# (the UID watermark, or today's emails on the first run), so they are never checked again.
+PROCESSED_RETENTION_DAYS = max(2, int(os.getenv("PROCESSED_RETENTION_DAYS", "30")))
+VACUUM_AFTER_ROWS = 1000  # Compact the database after pruning at least this many rows
+
+# Metrics settings
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # Served on 127.0.0.1, 0 disables the endpoint
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "0"))  # Minutes between metric dumps to the log, 0 disables
+
+IMAP_SECONDS = metrics.REGISTRY.histogram(
+    'mail_bot_imap_seconds', 'Duration of IMAP operations', ['operation'])
+IMAP_ERRORS = metrics.REGISTRY.counter(
+    'mail_bot_imap_errors_total', 'IMAP sessions or checks that ended with an error')
+MAIL_CHECK_SECONDS = metrics.REGISTRY.histogram(
+    'mail_bot_mail_check_seconds', 'Duration of one check of the sent mail folder')
+LAST_MAIL_CHECK = metrics.REGISTRY.gauge(
+    'mail_bot_last_mail_check_timestamp_seconds', 'Unix time of the last completed mail check')
+EMAILS_PROCESSED = metrics.REGISTRY.counter(
+    'mail_bot_emails_processed_total', 'Emails addressed to TOEMAIL that were processed')
+EMAIL_DELAY_SECONDS = metrics.REGISTRY.histogram(
+    'mail_bot_email_delay_seconds', 'Time from sending an email to processing it',
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400))
+ATTACHMENT_WRITE_SECONDS = metrics.REGISTRY.histogram(
+    'mail_bot_attachment_write_seconds', 'Duration of writing one attachment to disk')
+ATTACHMENTS_STORED = metrics.REGISTRY.counter(
+    'mail_bot_attachments_total', 'Image attachments handled', ['result'])
+ATTACHMENT_BYTES = metrics.REGISTRY.counter(
+    'mail_bot_attachment_bytes_total', 'Bytes of image attachments written to disk')
+SEND_FAILURES = metrics.REGISTRY.counter(
+    'mail_bot_send_failures_total', 'Failed sends by what happened to them', ['reason'])
+OUTBOX_SIZE = metrics.REGISTRY.gauge(
+    'mail_bot_outbox_jobs', 'Photo sends waiting in the outbox')
+SEND_SECONDS = metrics.REGISTRY.histogram(
+    'mail_bot_send_photo_seconds',
+    'Duration of one send_photo or send_media_group call including rate limiting', ['result'])
+IMAGE_SHRINK_SECONDS = metrics.REGISTRY.histogram(
+    'mail_bot_image_shrink_seconds', 'Duration of preparing one image for upload')
+UPLOAD_BYTES = metrics.REGISTRY.counter(
+    'mail_bot_upload_bytes_total', 'Bytes of photos uploaded to Telegram', ['kind'])
+DB_SECONDS = metrics.REGISTRY.histogram(
+    'mail_bot_db_seconds', 'Duration of database operations', ['operation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+SCHEDULER_LAG = metrics.REGISTRY.gauge(
+    'mail_bot_scheduler_lag_seconds', 'How late the last run of a periodic job started', ['job'])
+TASK_ALIVE = metrics.REGISTRY.gauge(
+    'mail_bot_task_alive', 'Whether a long-running task is running (1) or not (0)', ['task'])
+POLL_AGE = metrics.REGISTRY.gauge(
+    'mail_bot_polling_last_response_age_seconds', 'Seconds since getUpdates last returned')
+
+def timed_db(method):
+    """Record the duration of a MailBotDB method under its name."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with DB_SECONDS.time(operation=method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+# Queued photo send, see MailBotDB.enqueue_photo
+OutboxJob = namedtuple('OutboxJob', 'id chat_id attachment_hash filename caption email_uid attempts')
+
+class MailBotDB:
     """
-    Initialize the SQLite database and create necessary tables if they don't exist.
+    Thread-safe access layer for the bot's SQLite database.
+
+    Every thread gets its own long-lived connection, so the event loop and the IMAP
+    session thread never share a transaction. The database runs in WAL mode so
+    readers never block the writer, statements are reused from each connection's
+    statement cache and writes made inside batch() are committed once at the end of
+    the batch, or rolled back together if it fails.
     """
-    conn = sqlite3.connect('mail_bot.db')
-    c = conn.cursor()
-    
-    # Create table for storing processed email IDs
-    c.execute('''CREATE TABLE IF NOT EXISTS processed_emails
-                 (email_id TEXT PRIMARY KEY)''')
-    
-    # Create table for storing authorized chat information
-    c.execute('''CREATE TABLE IF NOT EXISTS authorized_chats
-                 (chat_id INTEGER PRIMARY KEY, username TEXT, is_active INTEGER DEFAULT 0)''')
-    
-    conn.commit()
-    conn.close()
 
-# Database functions
-def is_email_processed(email_id):
+    def __init__(self, path):
+        """
+        Open the database and create necessary tables if they don't exist.
+
+        :param path: Path to the SQLite database file
+        """
+        self.path = path
+        self._lock = threading.Lock()  # Guards _processed and _connections
+        self._local = threading.local()
+        self._connections = []
+        self._conn.execute('PRAGMA journal_mode=WAL')
+
+        # Create table for storing processed email IDs
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS processed_emails
+                              (email_id TEXT PRIMARY KEY, processed_at REAL)''')
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(processed_emails)")]
+        if 'processed_at' not in columns:
+            # Databases from before retention: keep the existing IDs for one retention period
+            self._conn.execute("ALTER TABLE processed_emails ADD COLUMN processed_at REAL")
+            self._conn.execute("UPDATE processed_emails SET processed_at = ?", (time.time(),))
+        self._conn.execute('''CREATE INDEX IF NOT EXISTS processed_emails_processed_at
+                              ON processed_emails (processed_at)''')
+
+        # Create table for storing authorized chat information
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS authorized_chats
+                              (chat_id INTEGER PRIMARY KEY, username TEXT, is_active INTEGER DEFAULT 0)''')
+
+        # Create table for indexing stored image attachments by payload hash
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS attachments
+                              (hash TEXT PRIMARY KEY, filename TEXT, email_uid TEXT, email_date TEXT,
+                               path TEXT, size INTEGER, stored_at REAL, last_seen REAL, file_id TEXT)''')
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(attachments)")]
+        if 'file_id' not in columns:
+            self._conn.execute("ALTER TABLE attachments ADD COLUMN file_id TEXT")
+
+        # Create table for photos waiting to be sent, one row per chat
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS outbox
+                              (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, attachment_hash TEXT,
+                               filename TEXT, caption TEXT, email_uid TEXT, attempts INTEGER DEFAULT 0,
+                               next_attempt REAL, created_at REAL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt)')
+
+        # Create table for storing the highest handled UID of each mail folder
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS mailbox_state
+                              (folder TEXT PRIMARY KEY, uidvalidity INTEGER, last_uid INTEGER)''')
+        self._conn.commit()
+
+        # Membership checks are answered from memory; the table only grows within the retention period
+        self._processed = {row[0] for row in self._conn.execute("SELECT email_id FROM processed_emails")}
+
+    @property
+    def _conn(self):
+        """Connection of the calling thread, opened on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=64)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.batch_depth = 0
+            self._local.pending = []  # Processed email IDs written in the open batch
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def batch(self):
+        """
+        Group the writes of the calling thread into a single transaction.
+        Batches may be nested; the outermost one commits, or rolls back on an error.
+        """
+        conn = self._conn
+        outermost = self._local.batch_depth == 0
+        self._local.batch_depth += 1
+        try:
+            yield self
+            if outermost:
+                conn.commit()
+        except BaseException:
+            if outermost:
+                conn.rollback()
+                self._local.pending.clear()
+            raise
+        finally:
+            self._local.batch_depth -= 1
+        if outermost:
+            self._remember_processed()
+
+    def _remember_processed(self):
+        with self._lock:
+            self._processed.update(self._local.pending)
+        self._local.pending.clear()
+
+    def _query(self, sql, params=()):
+        return self._conn.execute(sql, params).fetchall()
+
+    def _write(self, sql, params=(), durable=False):
+        """
+        Execute a write statement. It is committed right away unless a batch
+        is open in this thread; durable writes are always committed immediately.
+        """
+        conn = self._conn
+        cursor = conn.execute(sql, params)
+        if durable or self._local.batch_depth == 0:
+            conn.commit()
+        return cursor
+
+    def close_thread_connection(self):
+        """Close the calling thread's connection, for threads that are about to end"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+        self._local.conn = None
+
+    def close(self):
+        """Commit and close the connections of all threads"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.commit()
+                conn.close()
+            except sqlite3.Error as e:
+                logging.error(f"Error closing database connection: {str(e)}")
+
+    @timed_db
+    def is_email_processed(self, email_id):
+        """
+        Check if an email has already been processed.
+
+        :param email_id: The unique identifier of the email
+        :return: True if the email has been processed, False otherwise
+        """
+        return email_id in self._processed
+
+    @timed_db
+    def add_processed_email(self, email_id):
+        """
+        Mark an email as processed by adding its ID to the database.
+
+        :param email_id: The unique identifier of the email
+        """
+        self._write("INSERT OR IGNORE INTO processed_emails (email_id, processed_at) VALUES (?, ?)",
+                    (email_id, time.time()))
+        # Only committed IDs count as processed, a rolled back batch forgets them
+        self._local.pending.append(email_id)
+        if self._local.batch_depth == 0:
+            self._remember_processed()
+
+    @timed_db
+    def prune_processed_emails(self, retention_days):
+        """
+        Forget processed email IDs older than the retention period and compact the
+        database file if many rows were removed.
+
+        :param retention_days: Days to keep processed email IDs
+        :return: Number of removed IDs
+        """
+        cutoff = time.time() - retention_days * 86400
+        conn = self._conn
+        removed = conn.execute("DELETE FROM processed_emails WHERE processed_at < ?", (cutoff,)).rowcount
+        conn.commit()
+        if removed:
+            with self._lock:
+                self._processed = {row[0] for row in conn.execute("SELECT email_id FROM processed_emails")}
+        if removed >= VACUUM_AFTER_ROWS and self._local.batch_depth == 0:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if removed:
+            logging.info(f"Pruned {removed} processed email IDs older than {retention_days} days")
+        return removed
+
+    @timed_db
+    def get_mailbox_state(self, folder):
+        """
+        Get the UID watermark of a mail folder.
+
+        :param folder: Name of the IMAP folder
+        :return: (uidvalidity, last_uid) tuple, or None if the folder was never synced
+        """
+        rows = self._query("SELECT uidvalidity, last_uid FROM mailbox_state WHERE folder = ?", (folder,))
+        return rows[0] if rows else None
+
+    @timed_db
+    def set_mailbox_state(self, folder, uidvalidity, last_uid):
+        """
+        Store the UID watermark of a mail folder.
+
+        :param folder: Name of the IMAP folder
+        :param uidvalidity: UIDVALIDITY value the UIDs belong to
+        :param last_uid: Highest UID that has been handled
+        """
+        self._write("INSERT OR REPLACE INTO mailbox_state (folder, uidvalidity, last_uid) VALUES (?, ?, ?)",
+                    (folder, uidvalidity, last_uid))
+
+    @timed_db
+    def get_attachment_path(self, digest):
+        """
+        Look up a stored attachment and mark it as recently seen.
+
+        :param digest: SHA-256 hex digest of the payload
+        :return: Path of the stored file, or None if the payload is not stored
+        """
+        rows = self._query("SELECT path FROM attachments WHERE hash = ?", (digest,))
+        if rows:
+            self._write("UPDATE attachments SET last_seen = ? WHERE hash = ?", (time.time(), digest))
+        return rows[0][0] if rows else None
+
+    @timed_db
+    def add_attachment(self, digest, filename, email_uid, email_date, path, size):
+        """
+        Index a newly stored attachment.
+
+        :param digest: SHA-256 hex digest of the payload
+        :param filename: Original attachment name
+        :param email_uid: UID of the email the attachment came from
+        :param email_date: Sent date of the email
+        :param path: Path of the stored file
+        :param size: Payload size in bytes
+        """
+        now = time.time()
+        self._write("""INSERT OR REPLACE INTO attachments
+                       (hash, filename, email_uid, email_date, path, size, stored_at, last_seen)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (digest, filename, email_uid, email_date, path, size, now, now))
+
+    @timed_db
+    def get_attachment(self, digest):
+        """
+        :param digest: SHA-256 hex digest of the payload
+        :return: (path, file_id) of a stored attachment, file_id is None until it was uploaded
+        """
+        rows = self._query("SELECT path, file_id FROM attachments WHERE hash = ?", (digest,))
+        return rows[0] if rows else None
+
+    @timed_db
+    def set_attachment_file_id(self, digest, file_id):
+        """
+        Remember the Telegram file_id of an uploaded attachment, so it is sent by reference later.
+        """
+        self._write("UPDATE attachments SET file_id = ? WHERE hash = ?", (file_id, digest))
+
+    @timed_db
+    def get_attachments_by_age(self):
+        """
+        Attachments that still have to be sent are left out, so they are never evicted.
+
+        :return: List of (hash, path, size, last_seen) tuples, least recently seen first
+        """
+        return self._query("""SELECT hash, path, size, last_seen FROM attachments
+                              WHERE hash NOT IN (SELECT attachment_hash FROM outbox)
+                              ORDER BY last_seen""")
+
+    @timed_db
+    def delete_attachment(self, digest):
+        self._write("DELETE FROM attachments WHERE hash = ?", (digest,))
+
+    @timed_db
+    def enqueue_photo(self, chat_ids, digest, filename, caption, email_uid):
+        """
+        Queue a stored attachment for sending to each of the given chats.
+
+        :param chat_ids: Chats to send the photo to
+        :param digest: SHA-256 hex digest of the stored attachment
+        :param filename: Original attachment name
+        :param caption: Photo caption
+        :param email_uid: UID of the email the attachment came from
+        """
+        now = time.time()
+        conn = self._conn
+        conn.executemany(
+            """INSERT INTO outbox (chat_id, attachment_hash, filename, caption, email_uid,
+                                   attempts, next_attempt, created_at)
+               VALUES (?, ?, ?, ?, ?, 0, ?, ?)""",
+            [(chat_id, digest, filename, caption, email_uid, now, now) for chat_id in chat_ids])
+        if self._local.batch_depth == 0:
+            conn.commit()
+
+    @timed_db
+    def get_due_jobs(self, limit):
+        """
+        :param limit: Maximum number of jobs
+        :return: List of OutboxJob that are due, oldest first
+        """
+        rows = self._query("""SELECT id, chat_id, attachment_hash, filename, caption, email_uid, attempts
+                              FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT ?""", (time.time(), limit))
+        return [OutboxJob(*row) for row in rows]
+
+    @timed_db
+    def next_job_time(self):
+        """
+        :return: Unix time of the next queued send, or None if the queue is empty
+        """
+        return self._query("SELECT MIN(next_attempt) FROM outbox")[0][0]
+
+    @timed_db
+    def count_jobs(self):
+        return self._query("SELECT COUNT(*) FROM outbox")[0][0]
+
+    @timed_db
+    def complete_job(self, job_id):
+        self._write("DELETE FROM outbox WHERE id = ?", (job_id,))
+
+    @timed_db
+    def retry_job(self, job_id, attempts, next_attempt):
+        """
+        Reschedule a failed send.
+
+        :param job_id: Outbox row ID
+        :param attempts: Number of failed attempts so far
+        :param next_attempt: Unix time of the next attempt
+        """
+        self._write("UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                    (attempts, next_attempt, job_id))
+
+    @timed_db
+    def drop_chat_jobs(self, chat_id):
+        """
+        Remove all queued sends to a chat.
+
+        :return: Number of removed jobs
+        """
+        return self._write("DELETE FROM outbox WHERE chat_id = ?", (chat_id,)).rowcount
+
+    @timed_db
+    def get_authorized_chats(self):
+        """
+        Retrieve a list of authorized chat IDs from the database.
+
+        :return: A list of active chat IDs
+        """
+        return [row[0] for row in self._query("SELECT chat_id FROM authorized_chats WHERE is_active = 1")]
+
+    @timed_db
+    def add_or_update_chat(self, chat_id, username, is_active):
+        """
+        Add a new chat or update an existing chat's information in the database.
+
+        :param chat_id: The unique identifier of the Telegram chat
+        :param username: The username associated with the chat
+        :param is_active: Boolean indicating whether the chat is active
+        """
+        self._write("INSERT OR REPLACE INTO authorized_chats (chat_id, username, is_active) VALUES (?, ?, ?)",
+                    (chat_id, username, is_active), durable=True)
+
+    @timed_db
+    def subscribe_chat(self, chat_id, username):
+        """
+        Activate a chat for the given username, re-binding the chat ID if the
+        user is already known.
+
+        :param chat_id: The unique identifier of the Telegram chat
+        :param username: The username associated with the chat
+        :return: True if the user already existed, False if it was added
+        """
+        existing_user = self._query("SELECT chat_id, is_active FROM authorized_chats WHERE username = ?",
+                                    (username,))
+        if existing_user:
+            # Update existing user's chat_id and activate
+            self._write("UPDATE authorized_chats SET chat_id = ?, is_active = 1 WHERE username = ?",
+                        (chat_id, username), durable=True)
+        else:
+            # Add new user
+            self._write("INSERT INTO authorized_chats (chat_id, username, is_active) VALUES (?, ?, 1)",
+                        (chat_id, username), durable=True)
+        return bool(existing_user)
+
+    @timed_db
+    def update_authorized_chats(self, allowed_users):
+        """
+        Update the authorized chats in the database based on the allowed users list.
+        Only removes users that are no longer in the list.
+
+        :param allowed_users: Usernames that are allowed to use the bot
+        """
+        # Get current users from database
+        db_users = [row[0] for row in self._query("SELECT username FROM authorized_chats")]
+
+        # Remove users that are in database but not in allowed_users
+        for username in db_users:
+            if username not in allowed_users:
+                self._write("DELETE FROM authorized_chats WHERE username = ?", (username,))
+                logging.info(f"Removed unauthorized user {username} from database")
+
+def is_user_allowed(username):
     """
-    Check if an email has already been processed.
+    Check if a user is allowed to use the bot.
     
-    :param email_id: The unique identifier of the email
-    :return: True if the email has been processed, False otherwise
+    :param username: The username to check
+    :return: True if the user is allowed, False otherwise
     """
-    conn = sqlite3.connect('mail_bot.db')
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM processed_emails WHERE email_id = ?", (email_id,))
-    result = c.fetchone() is not None
-    conn.close()
-    return result
+    return username in ALLOWED_USERS
 
-def add_processed_email(email_id):
+def update_authorized_chats():
     """
-    Mark an email as processed by adding its ID to the database.
-    
-    :param email_id: The unique identifier of the email
+    Update the authorized chats in the database based on the ALLOWED_USERS list.
+    Only removes users that are no longer in ALLOWED_USERS.
     """
-    conn = sqlite3.connect('mail_bot.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO processed_emails (email_id) VALUES (?)", (email_id,))
-    conn.commit()
-    conn.close()
+    db.update_authorized_chats(ALLOWED_USERS)
+
+# A body part of an email as described by its BODYSTRUCTURE
+BodyPart = namedtuple('BodyPart', ['section', 'filename', 'encoding'])
+
+IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
 
-def get_authorized_chats():
+def parse_imap_response(data):
     """
-    Retrieve a list of authorized chat IDs from the database.
-    
-    :return: A list of active chat IDs
+    Parse an imaplib FETCH response into nested lists.
+    Literals sent by the server ({n} followed by raw bytes) become plain atoms.
+
+    :param data: Response data as returned by imaplib
+    :return: List of top-level items (message numbers and their attribute lists)
     """
-    conn = sqlite3.connect('mail_bot.db')
-    c = conn.cursor()
-    c.execute("SELECT chat_id FROM authorized_chats WHERE is_active = 1")
-    chats = [row[0] for row in c.fetchall()]
-    conn.close()
-    return chats
+    stack = [[]]
+    chunks = []
+    for item in data:
+        if isinstance(item, tuple):
+            chunks.append((re.sub(rb'\{\d+\}$', b'', item[0]), item[1]))
+        elif item:
+            chunks.append((item, None))
 
-def add_or_update_chat(chat_id, username, is_active):
+    for text, literal in chunks:
+        for match in IMAP_TOKEN_RE.finditer(text):
+            open_paren, close_paren, quoted, atom = match.groups()
+            if open_paren:
+                stack.append([])
+            elif close_paren:
+                if len(stack) > 1:
+                    finished = stack.pop()
+                    stack[-1].append(finished)
+            elif quoted is not None:
+                stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted))
+            elif atom is not None:
+                stack[-1].append(None if atom.upper() == b'NIL' else atom)
+        if literal is not None:
+            stack[-1].append(literal)
+    return stack[0]
+
+def _decode_header_value(value):
     """
-    Add a new chat or update an existing chat's information in the database.
-    
+    Decode an RFC 2047 encoded header value (e.g. =?UTF-8?B?...?=) to str.
+    """
+    value = value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+    return str(email.header.make_header(email.header.decode_header(value)))
+
+def _pairs_to_dict(pairs):
+    if not isinstance(pairs, list):
+        return {}
+    return {pairs[i].decode().lower(): pairs[i + 1] for i in range(0, len(pairs) - 1, 2)
+            if isinstance(pairs[i], bytes) and isinstance(pairs[i + 1], bytes)}
+
+def _part_filename(part):
+    """
+    Get the file name of a single BODYSTRUCTURE part from its Content-Disposition
+    or Content-Type parameters.
+    """
+    params = _pairs_to_dict(part[2])
+    disposition = {}
+    # The disposition is the first (type params) pair in the extension data
+    for ext in part[7:]:
+        if isinstance(ext, list) and len(ext) == 2 and isinstance(ext[0], bytes):
+            disposition = _pairs_to_dict(ext[1])
+            break
+    for source in (disposition, params):
+        if 'filename*' in source or 'name*' in source:
+            # RFC 2231 extended value: charset'language'percent-encoded-text
+            raw = (source.get('filename*') or source.get('name*')).decode('ascii', 'replace')
+            charset, _, encoded = raw.split("'", 2) if raw.count("'") >= 2 else ('', '', raw)
+            return urllib.parse.unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+        for key in ('filename', 'name'):
+            if source.get(key):
+                return _decode_header_value(source[key])
+    return None
+
+def body_parts(structure, prefix=''):
+    """
+    List the leaf parts of a parsed BODYSTRUCTURE.
+
+    :param structure: BODYSTRUCTURE value from parse_imap_response
+    :param prefix: Section number of the enclosing multipart
+    :return: List of BodyPart with section numbers usable in BODY[section]
+    """
+    if structure and isinstance(structure[0], list):
+        # Multipart: the child parts come first, followed by the subtype and extension data
+        parts = []
+        for index, child in enumerate(structure):
+            if not isinstance(child, list):
+                break
+            parts.extend(body_parts(child, f"{prefix}{index + 1}."))
+        return parts
+    encoding = (structure[5] or b'7BIT').decode().upper()
+    return [BodyPart(prefix.rstrip('.') or '1', _part_filename(structure), encoding)]
+
+def fetch_body_structures(mailbox, uids):
+    """
+    Get the BODYSTRUCTURE of several messages with one FETCH command.
+
+    :param mailbox: Logged in MailBox with a folder selected
+    :param uids: List of message UIDs
+    :return: Dict of UID -> list of BodyPart
+    """
+    if not uids:
+        return {}
+    with IMAP_SECONDS.time(operation='fetch_structure'):
+        typ, data = mailbox.client.uid('FETCH', ','.join(uids), '(UID BODYSTRUCTURE)')
+    if typ != 'OK':
+        raise RuntimeError(f"BODYSTRUCTURE fetch failed: {data}")
+    structures = {}
+    for item in parse_imap_response(data):
+        if isinstance(item, list):
+            attrs = dict(zip(item[::2], item[1::2]))
+            if b'UID' in attrs and b'BODYSTRUCTURE' in attrs:
+                structures[attrs[b'UID'].decode()] = body_parts(attrs[b'BODYSTRUCTURE'])
+    return structures
+
+def fetch_body_parts(mailbox, uid, parts):
+    """
+    Download only the given body parts of a message, without marking it as seen.
+
+    :param mailbox: Logged in MailBox with a folder selected
+    :param uid: Message UID
+    :param parts: List of BodyPart to download
+    :return: List of (filename, payload) tuples
+    """
+    if not parts:
+        return []
+    sections = ' '.join(f"BODY.PEEK[{part.section}]" for part in parts)
+    with IMAP_SECONDS.time(operation='fetch_parts'):
+        typ, data = mailbox.client.uid('FETCH', uid, f'({sections})')
+    if typ != 'OK':
+        raise RuntimeError(f"Body part fetch failed for UID {uid}: {data}")
+    raw = {}
+    for item in data:
+        if isinstance(item, tuple):
+            match = re.search(rb'BODY\[([\d.]+)\]\s*\{\d+\}$', item[0])
+            if match:
+                raw[match.group(1).decode()] = item[1]
+    attachments = []
+    for part in parts:
+        payload = raw.get(part.section, b'')
+        if part.encoding == 'BASE64':
+            payload = base64.b64decode(payload)
+        elif part.encoding == 'QUOTED-PRINTABLE':
+            payload = quopri.decodestring(payload)
+        attachments.append((part.filename, payload))
+    return attachments
+
+class AttachmentStore:
+    """
+    Content-addressed store for image attachments.
+
+    Files are saved under the SHA-256 of their payload, so attachments that share a
+    name no longer overwrite each other and identical payloads are written only once.
+    The original name, email UID and date are kept in the attachments table.
+    """
+
+    def __init__(self, folder, database, max_bytes=None, max_age_days=None):
+        self.folder = folder
+        self.db = database
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+
+    def put(self, payload, filename, email_uid, email_date):
+        """
+        Store an attachment unless the same payload is already stored.
+
+        :param payload: Attachment content
+        :param filename: Original attachment name
+        :param email_uid: UID of the email the attachment came from
+        :param email_date: Sent date of the email
+        :return: SHA-256 hex digest of the payload
+        """
+        digest = hashlib.sha256(payload).hexdigest()
+        if self.db.get_attachment_path(digest):
+            ATTACHMENTS_STORED.inc(result='duplicate')
+            logging.info(f"Image already stored: {filename} ({digest[:12]})")
+            return digest
+
+        ext = os.path.splitext(filename)[1].lower()
+        subfolder = os.path.join(self.folder, digest[:2])
+        os.makedirs(subfolder, exist_ok=True)
+        path = os.path.join(subfolder, digest + ext)
+        with ATTACHMENT_WRITE_SECONDS.time():
+            with open(path, "wb") as f:
+                f.write(payload)
+        ATTACHMENTS_STORED.inc(result='stored')
+        ATTACHMENT_BYTES.inc(len(payload))
+        self.db.add_attachment(digest, filename, email_uid, email_date, path, len(payload))
+        logging.info(f"Saved image: {filename} ({digest[:12]})")
+        return digest
+
+    def evict(self):
+        """
+        Remove attachments older than max_age_days, then the least recently seen
+        ones until the store fits into max_bytes.
+        """
+        if not self.max_bytes and not self.max_age_days:
+            return
+        entries = self.db.get_attachments_by_age()
+        total = sum(size for _, _, size, _ in entries)
+        cutoff = time.time() - self.max_age_days * 86400 if self.max_age_days else None
+        for digest, path, size, last_seen in entries:
+            expired = cutoff is not None and last_seen < cutoff
+            if not expired and (not self.max_bytes or total <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.db.delete_attachment(digest)
+            total -= size
+            logging.info(f"Evicted stored image: {path}")
+
+class RateLimiter:
+    """
+    Space out Telegram API calls to stay within the global and per-chat rate limits.
+    Each call reserves the next free slot, so concurrent senders queue up fairly.
+    Slots are reserved without awaiting, so no lock is needed within the event loop.
+    """
+
+    def __init__(self, global_rate, chat_interval):
+        self._global_interval = 1.0 / global_rate
+        self._chat_interval = chat_interval
+        self._next_global = 0.0
+        self._next_chat = {}
+
+    async def wait(self, chat_id):
+        """
+        Wait until a message may be sent to the given chat.
+
+        :param chat_id: The unique identifier of the Telegram chat
+        """
+        now = time.monotonic()
+        slot = max(now, self._next_global, self._next_chat.get(chat_id, 0.0))
+        self._next_global = slot + self._global_interval
+        self._next_chat[chat_id] = slot + self._chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        """
+        Hold back all sends for the given time, after Telegram answered 429.
+        """
+        self._next_global = max(self._next_global, time.monotonic() + seconds)
+
+rate_limiter = RateLimiter(GLOBAL_SEND_RATE, CHAT_SEND_INTERVAL)
+send_slots = asyncio.Semaphore(SEND_WORKERS)  # Limits concurrent Telegram uploads
+outbox_ready = asyncio.Event()  # Set when new sends are queued
+image_pool = None  # ProcessPoolExecutor for shrink_image, started in main()
+
+def retry_delay(attempts):
+    """
+    :param attempts: Failed attempts so far
+    :return: Seconds to wait before the next attempt (exponential backoff)
+    """
+    return min(SEND_RETRY_MAX, SEND_RETRY_MIN * 2 ** (attempts - 1))
+
+def reschedule_job(job, reason, delay=None):
+    """
+    Schedule another attempt of a failed send, or drop it after SEND_MAX_ATTEMPTS.
+
+    :param job: OutboxJob that failed
+    :param reason: Error description for the log
+    :param delay: Seconds to wait, exponential backoff if not given
+    """
+    attempts = job.attempts + 1
+    if attempts >= SEND_MAX_ATTEMPTS:
+        logging.error(f"Giving up sending {job.filename} to chat_id {job.chat_id} "
+                      f"after {attempts} attempts: {reason}")
+        SEND_FAILURES.inc(reason='gave_up')
+        db.complete_job(job.id)
+        return
+    delay = retry_delay(attempts) if delay is None else delay
+    logging.warning(f"Sending {job.filename} to chat_id {job.chat_id} failed ({reason}), retrying in {delay} s")
+    SEND_FAILURES.inc(reason='retry')
+    db.retry_job(job.id, attempts, time.time() + delay)
+
+async def load_photo(path, filename):
+    """
+    Read a stored image for upload. Images that are larger than needed are downscaled
+    and re-encoded in the image worker processes; the stored original is not changed.
+
+    :param path: Path of the stored image
+    :param filename: Original attachment name
+    :return: File object to upload
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        payload = await loop.run_in_executor(image_pool, images.shrink_image, path, IMAGE_MAX_SIDE,
+                                             IMAGE_QUALITY, IMAGE_SHRINK_KB * 1024)
+    except Exception as e:
+        logging.warning(f"Could not shrink {filename}, uploading the original: {str(e)}")
+        payload = None
+    IMAGE_SHRINK_SECONDS.observe(time.perf_counter() - start)
+
+    if payload is None:
+        with open(path, 'rb') as f:
+            photo = io.BytesIO(f.read())
+        photo.name = filename
+        UPLOAD_BYTES.inc(len(photo.getvalue()), kind='original')
+    else:
+        photo = io.BytesIO(payload)
+        photo.name = os.path.splitext(filename)[0] + '.jpg'
+        UPLOAD_BYTES.inc(len(payload), kind='shrunk')
+        logging.info(f"Shrunk {filename} from {os.path.getsize(path)} to {len(payload)} bytes")
+    return photo
+
+async def send_jobs(chat_id, jobs, media):
+    """
+    Send queued photos to one chat and update the queue with the outcome. A single
+    photo is sent with send_photo, several as an album with the caption of the first job.
+
+    Sent jobs are removed. On 429 the jobs and all other sends wait for retry_after.
+    Chats that are gone or blocked the bot (400 "chat not found", 403) are deactivated
+    and their queued sends removed. Other client errors drop the jobs; server and
+    network errors are retried with exponential backoff.
+
     :param chat_id: The unique identifier of the Telegram chat
-    :param username: The username associated with the chat
-    :param is_active: Boolean indicating whether the chat is active
+    :param jobs: OutboxJob list to send, at most MEDIA_GROUP_SIZE
+    :param media: File object to upload or file_id of an already uploaded photo, per job
+    :return: The sent Messages in the order of jobs, or None if sending failed
     """
-    conn = sqlite3.connect('mail_bot.db')
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO authorized_chats (chat_id, username, is_active) VALUES (?, ?, ?)", 
-              (chat_id, username, is_active))
-    conn.commit()
-    conn.close()
+    start = time.perf_counter()
+    try:
+        async with send_slots:
+            await rate_limiter.wait(chat_id)
+            if len(jobs) == 1:
+                messages = [await bot.send_photo(chat_id, media[0], caption=jobs[0].caption)]
+            else:
+                album = [types.InputMediaPhoto(photo, caption=jobs[0].caption if i == 0 else None)
+                         for i, photo in enumerate(media)]
+                messages = await bot.send_media_group(chat_id, album)
+    except asyncio_helper.ApiTelegramException as e:
+        SEND_SECONDS.observe(time.perf_counter() - start, result='error')
+        if e.error_code == 429:
+            retry_after = int((e.result_json.get('parameters') or {}).get('retry_after', SEND_RETRY_MIN))
+            rate_limiter.pause(retry_after)
+            for job in jobs:
+                reschedule_job(job, e.description, delay=retry_after)
+        elif e.error_code == 403 or (e.error_code == 400 and "chat not found" in e.description):
+            logging.warning(f"Chat unavailable for chat_id: {chat_id} ({e.description}). Deactivating in database.")
+            db.add_or_update_chat(chat_id, None, 0)
+            db.drop_chat_jobs(chat_id)
+            SEND_FAILURES.inc(reason='chat_unavailable')
+        elif e.error_code < 500:
+            logging.error(f"Error sending {len(jobs)} image(s) to chat_id {chat_id}: {str(e)}")
+            SEND_FAILURES.inc(len(jobs), reason='rejected')
+            for job in jobs:
+                db.complete_job(job.id)
+        else:
+            for job in jobs:
+                reschedule_job(job, e.description)
+        return None
+    except Exception as e:
+        SEND_SECONDS.observe(time.perf_counter() - start, result='error')
+        for job in jobs:
+            reschedule_job(job, str(e) or type(e).__name__)
+        return None
+    SEND_SECONDS.observe(time.perf_counter() - start, result='ok')
+    with db.batch():
+        for job in jobs:
+            db.complete_job(job.id)
+    for job in jobs:
+        logging.info(f"Sent image to Telegram: {job.filename} (chat_id: {job.chat_id}, email UID: {job.email_uid})")
+    return messages
 
-def is_user_allowed(username):
+async def send_album(jobs, paths, file_ids):
     """
-    Check if a user is allowed to use the bot.
-    
-    :param username: The username to check
-    :return: True if the user is allowed, False otherwise
+    Send one album of an email to one chat, uploading the photos that have no file_id
+    yet and remembering the file_ids Telegram returns for them.
+
+    :param jobs: OutboxJob list of one chat
+    :param paths: Stored image path by attachment hash
+    :param file_ids: Telegram file_id by attachment hash, None if not uploaded yet
     """
-    return username in ALLOWED_USERS
+    media = []
+    for job in jobs:
+        file_id = file_ids[job.attachment_hash]
+        media.append(file_id or await load_photo(paths[job.attachment_hash], job.filename))
+    messages = await send_jobs(jobs[0].chat_id, jobs, media)
+    if not messages:
+        return
+    for job, message in zip(jobs, messages):
+        if file_ids[job.attachment_hash] is None and message.photo:
+            file_ids[job.attachment_hash] = message.photo[-1].file_id
+            db.set_attachment_file_id(job.attachment_hash, file_ids[job.attachment_hash])
 
-def update_authorized_chats():
+async def send_email_jobs(jobs):
     """
-    Update the authorized chats in the database based on the ALLOWED_USERS list.
-    Only removes users that are no longer in ALLOWED_USERS.
+    Send the queued jobs of one email: the photos go to every chat as albums of up to
+    MEDIA_GROUP_SIZE. Each attachment is uploaded once, with the first album that
+    succeeds, and sent to the other chats by its Telegram file_id.
+
+    :param jobs: OutboxJob list of one email
     """
-    conn = sqlite3.connect('mail_bot.db')
-    c = conn.cursor()
-    
-    # Get current users from database
-    c.execute("SELECT username, chat_id FROM authorized_chats")
-    db_users = {row[0]: row[1] for row in c.fetchall()}
-    
-    # Remove users that are in database but not in ALLOWED_USERS
-    for username in list(db_users.keys()):
-        if username not in ALLOWED_USERS:
-            c.execute("DELETE FROM authorized_chats WHERE username = ?", (username,))
-            logging.info(f"Removed unauthorized user {username} from database")
-    
-    conn.commit()
-    conn.close()
+    paths, file_ids = {}, {}
+    albums = {}
+    for job in jobs:
+        if job.attachment_hash not in paths:
+            attachment = db.get_attachment(job.attachment_hash)
+            if attachment is None or not os.path.exists(attachment[0]):
+                attachment = (None, None)
+            paths[job.attachment_hash], file_ids[job.attachment_hash] = attachment
+        if paths[job.attachment_hash] is None:
+            logging.error(f"Stored image missing, not sending {job.filename} to chat_id {job.chat_id}")
+            db.complete_job(job.id)
+            continue
+        albums.setdefault(job.chat_id, []).append(job)
+    pending = [chat_jobs[i:i + MEDIA_GROUP_SIZE]
+               for chat_jobs in albums.values()
+               for i in range(0, len(chat_jobs), MEDIA_GROUP_SIZE)]
+
+    # Send the albums with photos that still need uploading one at a time
+    while True:
+        upload = next((album for album in pending
+                       if any(file_ids[job.attachment_hash] is None for job in album)), None)
+        if upload is None:
+            break
+        pending.remove(upload)
+        await send_album(upload, paths, file_ids)
+
+    # Fan out the rest by reference
+    await asyncio.gather(*(send_album(album, paths, file_ids) for album in pending))
 
-def fetch_emails():
+async def run_sender():
     """
-    Fetch new emails from the sent mail folder, process attachments, and send them to authorized Telegram chats.
+    Drain the outbox: send due jobs, then sleep until new jobs are queued or the
+    next retry is due. Jobs survive restarts, unsent ones are picked up again.
+    The outbox size gauge is updated here, from the event loop, whenever jobs were
+    queued or sent.
+    """
+    while True:
+        outbox_ready.clear()
+        OUTBOX_SIZE.set(db.count_jobs())
+        jobs = db.get_due_jobs(SEND_BATCH)
+        if jobs:
+            by_email = {}
+            for job in jobs:
+                by_email.setdefault(job.email_uid, []).append(job)
+            await asyncio.gather(*(send_email_jobs(email_jobs) for email_jobs in by_email.values()))
+            continue
+
+        next_time = db.next_job_time()
+        timeout = None if next_time is None else max(0.0, next_time - time.time())
+        try:
+            await asyncio.wait_for(outbox_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def process_mailbox(mailbox, notify):
+    """
+    Process new emails in the selected sent mail folder: save image attachments and
+    queue them for sending to authorized Telegram chats.
+
+    Only messages above the stored UID watermark are requested. Their headers are
+    checked first and only the image parts of emails addressed to TO_EMAIL are downloaded.
+
+    :param mailbox: Logged in MailBox with the sent mail folder selected
+    :param notify: Function called after each email whose sends were queued is committed
     """
     logging.info("Starting to check sent mail")
+    check_start = time.perf_counter()
+
+    with IMAP_SECONDS.time(operation='status'):
+        status = mailbox.folder.status(SENT_FOLDER, ['UIDVALIDITY', 'UIDNEXT'])
+    uidvalidity = status['UIDVALIDITY']
+    state = db.get_mailbox_state(SENT_FOLDER)
+    if state and state[0] == uidvalidity:
+        last_uid = state[1]
+        new_last_uid = last_uid
+        criteria = A(uid=U(str(last_uid + 1), '*'))
+    else:
+        # First run or the folder was rebuilt on the server: start from today's emails
+        last_uid = 0
+        new_last_uid = status['UIDNEXT'] - 1
+        one_hour_ago = datetime.now() - timedelta(hours=1)
+        criteria = A(date_gte=one_hour_ago.date())
+
+    # A UID range ending in * always matches the newest message, so filter again
+    with IMAP_SECONDS.time(operation='fetch_headers'):
+        headers = [msg for msg in mailbox.fetch(criteria, headers_only=True, mark_seen=False, bulk=True)
+                   if int(msg.uid) > last_uid]
+
+    # Check if the specified email address is in the "To" field
+    messages = sorted((msg for msg in headers if TO_EMAIL in msg.to and not db.is_email_processed(msg.uid)),
+                      key=lambda msg: int(msg.uid))
+    structures = fetch_body_structures(mailbox, [msg.uid for msg in messages])
+
+    for msg in messages:
+        logging.info(f"Processing email: {msg.subject}")
+
+        # Format the sent date
+        sent_date = msg.date.strftime("%Y-%m-%d %H:%M:%S")
+        image_parts = [part for part in structures.get(msg.uid, [])
+                       if part.filename and part.filename.lower().endswith(IMAGE_EXTENSIONS)]
+        # Downloaded and stored before the transaction, so it does not stay open during network I/O
+        stored = [(attachment_store.put(payload, filename, msg.uid, sent_date), filename)
+                  for filename, payload in fetch_body_parts(mailbox, msg.uid, image_parts)]
 
+        # The queued sends, the processed flag and the watermark of an email are committed together
+        with db.batch():
+            chat_ids = db.get_authorized_chats()
+            for digest, filename in stored:
+                db.enqueue_photo(chat_ids, digest, filename, f"Изображение отправлено: {sent_date}", msg.uid)
+            # Mark email as processed regardless of whether it has image attachments
+            db.add_processed_email(msg.uid)
+            # All lower UIDs are done: skipped, processed before or earlier in this loop
+            db.set_mailbox_state(SENT_FOLDER, uidvalidity, max(last_uid, int(msg.uid)))
+        # Wake the sender now, a later email failing must not hold back this one's photos
+        if stored:
+            notify()
+        EMAILS_PROCESSED.inc()
+        mail_alive()
+        if msg.date.tzinfo:
+            EMAIL_DELAY_SECONDS.observe(max(0.0, time.time() - msg.date.timestamp()))
+
+    # Emails that are not for TO_EMAIL move the watermark too
+    new_last_uid = max([new_last_uid] + [int(msg.uid) for msg in headers])
+    db.set_mailbox_state(SENT_FOLDER, uidvalidity, new_last_uid)
+
+    MAIL_CHECK_SECONDS.observe(time.perf_counter() - check_start)
+    LAST_MAIL_CHECK.set(time.time())
+    mail_alive()
+    logging.info("Finished checking sent mail")
+
+# Set to stop the IMAP session threads
+mail_stop = threading.Event()
+current_mailbox = None  # Open IMAP session, interrupted on shutdown
+last_mail_activity = time.monotonic()  # Checked by check_liveness, see mail_alive
+
+def mail_alive():
+    """Record that the mail thread made progress: finished a check, an email, an IDLE
+    cycle or a reconnect attempt"""
+    global last_mail_activity
+    last_mail_activity = time.monotonic()
+
+def login_mailbox():
+    """
+    Open an authenticated IMAP session.
+
+    :return: Logged in MailBox, to be used as a context manager
+    """
+    global current_mailbox
+    with IMAP_SECONDS.time(operation='login'):
+        current_mailbox = MailBox(IMAP_SERVER, timeout=IMAP_TIMEOUT).login(EMAIL, PASSWORD)
+    return current_mailbox
+
+def select_sent_folder(mailbox):
+    with IMAP_SECONDS.time(operation='select'):
+        mailbox.folder.set(SENT_FOLDER)
+
+def interrupt_mailbox():
+    """
+    Unblock the IMAP session thread by shutting down its socket; the session then
+    fails and the thread sees mail_stop.
+    """
+    mailbox = current_mailbox
+    if mailbox is None:
+        return
     try:
-        with MailBox(IMAP_SERVER).login(EMAIL, PASSWORD) as mailbox:
-            mailbox.folder.set('[Gmail]/Отправленные')
-            one_hour_ago = datetime.now() - timedelta(hours=1)
-            for msg in mailbox.fetch(A(date_gte=one_hour_ago.date())):
-                if is_email_processed(msg.uid):
-                    continue
-
-                # Check if the specified email address is in the "To" field
-                if TO_EMAIL not in msg.to:
-                    continue
-
-                logging.info(f"Processing email: {msg.subject}")
-
-                has_image_attachment = False
-                for att in msg.attachments:
-                    if att.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                        has_image_attachment = True
-                        filepath = os.path.join(PICTURES_FOLDER, att.filename)
-                        with open(filepath, "wb") as f:
-                            f.write(att.payload)
-                        
-                        logging.info(f"Saved image: {att.filename}")
-                        
-                        # Format the sent date
-                        sent_date = msg.date.strftime("%Y-%m-%d %H:%M:%S")
-                        
-                        for chat_id in get_authorized_chats():
-                            try:
-                                with open(filepath, "rb") as photo:
-                                    bot.send_photo(chat_id, photo, caption=f"Изображение отправлено: {sent_date}")
-                                logging.info(f"Sent image to Telegram: {att.filename} (chat_id: {chat_id})")
-                            except telebot.apihelper.ApiTelegramException as e:
-                                if e.error_code == 400 and "chat not found" in e.description:
-                                    logging.warning(f"Chat not found for chat_id: {chat_id}. Deactivating in database.")
-                                    add_or_update_chat(chat_id, None, 0)
-                                else:
-                                    logging.error(f"Error sending image to chat_id {chat_id}: {str(e)}")
-
-                # Mark email as processed regardless of whether it has image attachments
-                add_processed_email(msg.uid)
-
-        logging.info("Finished checking sent mail")
+        mailbox.client.sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass
+
+def fetch_emails(notify):
+    """
+    Fetch new emails from the sent mail folder, process attachments, and send them to authorized Telegram chats.
+    Opens a new IMAP session for every call; used in polling mode.
+
+    :param notify: Function called after new sends were queued, see process_mailbox
+    """
+    try:
+        with login_mailbox() as mailbox:
+            select_sent_folder(mailbox)
+            process_mailbox(mailbox, notify)
     except Exception as e:
+        if mail_stop.is_set():
+            return
+        mail_alive()
+        IMAP_ERRORS.inc()
         logging.error(f"Error while checking mail: {str(e)}", exc_info=True)
 
-def scheduled_check():
+def watch_mailbox(notify):
     """
-    Perform a scheduled check of emails and update authorized chats.
+    Keep one authenticated IMAP session open and process the sent mail folder
+    whenever the server reports changes through IDLE.
+    Lost sessions are re-established with exponential backoff.
+
+    :param notify: Function called after new sends were queued, see process_mailbox
+    :return: False if the server does not support IDLE, True once mail_stop is set
     """
-    update_authorized_chats()
-    fetch_emails()
+    delay = RECONNECT_DELAY_MIN
+    while not mail_stop.is_set():
+        try:
+            with login_mailbox() as mailbox:
+                if 'IDLE' not in mailbox.client.capabilities:
+                    logging.warning("IMAP server does not support IDLE")
+                    return False
+                select_sent_folder(mailbox)
+                logging.info("IMAP session opened, waiting for new mail")
+                delay = RECONNECT_DELAY_MIN
+
+                # Catch up on anything that arrived while we were disconnected
+                process_mailbox(mailbox, notify)
+                while not mail_stop.is_set():
+                    if mailbox.idle.wait(timeout=IDLE_TIMEOUT):
+                        process_mailbox(mailbox, notify)
+                    else:
+                        # Nothing new: the IDLE cycle is a completed check
+                        LAST_MAIL_CHECK.set(time.time())
+                        mail_alive()
+        except Exception as e:
+            if mail_stop.is_set():
+                break
+            mail_alive()
+            IMAP_ERRORS.inc()
+            logging.error(f"IMAP session lost: {str(e)}. Reconnecting in {delay} s", exc_info=True)
+            mail_stop.wait(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+    return True
+
+def run_in_thread(func, *args):
+    """
+    Run a blocking function in a new daemon thread and return an awaitable for its
+    result. Unlike asyncio.to_thread, a thread stuck in network I/O cannot hold up
+    the shutdown of the process. The thread's database connection is closed when
+    the function returns.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(setter, value):
+        if not future.done():
+            setter(value)
+
+    def runner():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            outcome = (future.set_exception, e)
+        else:
+            outcome = (future.set_result, result)
+        finally:
+            db.close_thread_connection()
+        try:
+            loop.call_soon_threadsafe(set_result, *outcome)
+        except RuntimeError:
+            pass  # The event loop is already closed
+
+    threading.Thread(target=runner, name=func.__name__, daemon=True).start()
+    return future
 
-@bot.message_handler(commands=['start'])
-def handle_start(message):
+async def watch_mail(stop):
+    """
+    Watch the sent mail folder in push mode, falling back to polling
+    every POLL_INTERVAL seconds if IDLE is not available.
+
+    The IMAP session runs in a separate thread, so a slow server never blocks the
+    event loop. Images found by the session are queued and sent by run_sender.
+
+    :param stop: asyncio.Event set on shutdown
+    """
+    loop = asyncio.get_running_loop()
+
+    def notify():
+        loop.call_soon_threadsafe(outbox_ready.set)
+
+    if MAIL_MODE == 'idle':
+        if await run_in_thread(watch_mailbox, notify):
+            return
+    logging.info(f"Checking mail by polling every {POLL_INTERVAL} s")
+    while not stop.is_set():
+        await run_in_thread(fetch_emails, notify)
+        try:
+            await asyncio.wait_for(stop.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def handle_start(message):
     """
     Handle the /start command for the Telegram bot.
     Adds new users to the database only when they interact with the bot.
@@ -208,77 +1266,226 @@ def handle_start(message):
     username = f"@{message.from_user.username}" if message.from_user.username else None
     
     if not username:
-        bot.reply_to(message, "Для использования бота необходимо иметь username в Telegram.")
+        await bot.reply_to(message, "Для использования бота необходимо иметь username в Telegram.")
         logging.warning(f"User without username attempted to start bot (chat_id: {message.chat.id})")
         return
     
     if is_user_allowed(username):
-        conn = sqlite3.connect('mail_bot.db')
-        c = conn.cursor()
-        
-        # Check if user already exists
-        c.execute("SELECT chat_id, is_active FROM authorized_chats WHERE username = ?", (username,))
-        existing_user = c.fetchone()
-        
-        if existing_user:
-            # Update existing user's chat_id and activate
-            c.execute("UPDATE authorized_chats SET chat_id = ?, is_active = 1 WHERE username = ?",
-                     (message.chat.id, username))
-            bot.reply_to(message, "Вы успешно переподключились к боту.")
+        if db.subscribe_chat(message.chat.id, username):
+            await bot.reply_to(message, "Вы успешно переподключились к боту.")
         else:
-            # Add new user
-            c.execute("INSERT INTO authorized_chats (chat_id, username, is_active) VALUES (?, ?, 1)",
-                     (message.chat.id, username))
-            bot.reply_to(message, "Вы успешно подписались на уведомления.")
-        
-        conn.commit()
-        conn.close()
+            await bot.reply_to(message, "Вы успешно подписались на уведомления.")
         logging.info(f"User {username} (chat_id: {message.chat.id}) subscribed to notifications")
     else:
-        bot.reply_to(message, "К сожалению, у Вас нет разрешения на использование этого бота.")
+        await bot.reply_to(message, "К сожалению, у Вас нет разрешения на использование этого бота.")
         logging.warning(f"Unauthorized subscription attempt by user {username} (chat_id: {message.chat.id})")
 
-@bot.message_handler(commands=['stop'])
-def handle_stop(message):
+async def handle_stop(message):
     """
     Handle the /stop command for the Telegram bot.
     """
     username = f"@{message.from_user.username}" if message.from_user.username else None
     if is_user_allowed(username):
-        add_or_update_chat(message.chat.id, username, 0)
-        bot.reply_to(message, "Вы отписались от получения уведомлений.")
+        db.add_or_update_chat(message.chat.id, username, 0)
+        await bot.reply_to(message, "Вы отписались от получения уведомлений.")
         logging.info(f"User {username} (chat_id: {message.chat.id}) unsubscribed from notifications")
     else:
-        bot.reply_to(message, "К сожалению, у Вас нет разрешения на использование этого бота.")
+        await bot.reply_to(message, "К сожалению, у Вас нет разрешения на использование этого бота.")
         logging.warning(f"Unauthorized unsubscribe attempt by user {username} (chat_id: {message.chat.id})")
 
-@bot.message_handler(func=lambda message: True)
-def log_all_messages(message):
+async def log_all_messages(message):
     """
     Log all received messages for debugging purposes.
     """
     username = f"@{message.from_user.username}" if message.from_user.username else None
     logging.info(f"Received message from user {username} (chat_id: {message.chat.id}): {message.text}")
 
-# Schedule the email check to run every minute
-schedule.every(1).minutes.do(scheduled_check)
+def create_bot():
+    """
+    Create the Telegram bot and register the command handlers.
 
-def run_bot():
+    :return: HeartbeatBot
     """
-    Main function to run the bot and handle scheduled tasks.
+    telegram_bot = HeartbeatBot(BOT_TOKEN)
+    telegram_bot.register_message_handler(handle_start, commands=['start'])
+    telegram_bot.register_message_handler(handle_stop, commands=['stop'])
+    telegram_bot.register_message_handler(log_all_messages, func=lambda message: True)
+    return telegram_bot
+
+class Heartbeat:
     """
-    logging.info("Bot started")
-    init_db()
-    update_authorized_chats()
-    bot_thread = threading.Thread(target=bot.polling, args=(None, True))
-    bot_thread.start()
+    Liveness signal of the bot: touches a heartbeat file and, when started by
+    systemd with Type=notify, sends sd_notify messages (READY=1, WATCHDOG=1) to
+    the socket in NOTIFY_SOCKET.
+    """
+    def __init__(self, path, notify_socket=None):
+        self.path = path
+        self.notify_socket = notify_socket
+        if notify_socket and notify_socket.startswith('@'):
+            # Abstract namespace socket
+            self.notify_socket = '\0' + notify_socket[1:]
+        self.healthy = True
+
+    def notify(self, message):
+        """Send one sd_notify message, does nothing outside systemd"""
+        if not self.notify_socket:
+            return
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.connect(self.notify_socket)
+                sock.sendall(message.encode())
+        except OSError as e:
+            logging.error(f"Error sending {message} to systemd: {str(e)}")
+
+    def beat(self):
+        try:
+            with open(self.path, 'w') as f:
+                f.write(f"{time.time():.0f}\n")
+        except OSError as e:
+            logging.error(f"Error writing heartbeat file: {str(e)}")
+        self.notify('WATCHDOG=1')
+
+    def interval(self):
+        """Seconds between heartbeats: HEARTBEAT_INTERVAL, or half the systemd
+        watchdog timeout if that is shorter"""
+        watchdog_usec = os.getenv('WATCHDOG_USEC')
+        if watchdog_usec and watchdog_usec.isdigit() and int(watchdog_usec) > 0:
+            return max(1, min(HEARTBEAT_INTERVAL, int(watchdog_usec) // 2_000_000))
+        return HEARTBEAT_INTERVAL
+
+heartbeat = Heartbeat(HEARTBEAT_FILE, os.getenv('NOTIFY_SOCKET'))
+
+def check_liveness(polling_task, mail_task, sender_task):
+    """
+    Send a heartbeat if the polling, mail and sender tasks are running and neither
+    polling nor the mail thread is stuck. Runs from the event loop, so a blocked loop
+    stops the heartbeat too.
+    """
+    TASK_ALIVE.set(int(not polling_task.done()), task='polling')
+    TASK_ALIVE.set(int(not mail_task.done()), task='mail')
+    TASK_ALIVE.set(int(not sender_task.done()), task='sender')
+
+    problems = []
+    if polling_task.done():
+        problems.append("polling stopped")
+    elif time.monotonic() - bot.last_poll > POLL_STALE_AFTER:
+        problems.append(f"no getUpdates response for {time.monotonic() - bot.last_poll:.0f} seconds")
+    if mail_task.done():
+        problems.append("mail watcher stopped")
+    elif time.monotonic() - last_mail_activity > MAIL_STALE_AFTER:
+        problems.append(f"no mail check finished for {time.monotonic() - last_mail_activity:.0f} seconds")
+    if sender_task.done():
+        problems.append("sender stopped")
+
+    if problems:
+        if heartbeat.healthy:
+            logging.error(f"Heartbeat stopped: {', '.join(problems)}")
+        heartbeat.healthy = False
+        return
+    if not heartbeat.healthy:
+        logging.info("Heartbeat resumed")
+    heartbeat.healthy = True
+    heartbeat.beat()
+
+def log_metrics():
+    """Write the current metric values to the log."""
+    logging.info("Metrics:\n" + "\n".join(metrics.REGISTRY.summary()))
+
+def start_metrics():
+    """Serve the metrics on localhost."""
+    POLL_AGE.set_function(lambda: time.monotonic() - bot.last_poll)
+    if METRICS_PORT:
+        try:
+            metrics.start_http_server(METRICS_PORT)
+            logging.info(f"Metrics available at http://127.0.0.1:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logging.error(f"Could not start metrics endpoint on port {METRICS_PORT}: {str(e)}")
+
+async def run_every(seconds, job, name=None):
+    """
+    Run job every `seconds` seconds, awaiting it if it returns an awaitable.
+    Errors are logged and do not stop the schedule. The start lag is recorded
+    under `name`, the function name of job by default.
+    """
+    name = name or getattr(job, '__name__', str(job))
+    loop = asyncio.get_running_loop()
+    next_run = loop.time() + seconds
     while True:
+        await asyncio.sleep(max(0.0, next_run - loop.time()))
+        SCHEDULER_LAG.set(max(0.0, loop.time() - next_run), job=name)
         try:
-            schedule.run_pending()
-            time.sleep(1)
+            result = job()
+            if inspect.isawaitable(result):
+                await result
         except Exception as e:
-            logging.error(f"Error in bot operation: {str(e)}")
-            time.sleep(1)
+            logging.error(f"Error in scheduled job {name}: {str(e)}")
+        next_run = max(next_run + seconds, loop.time())
+
+async def main():
+    """
+    Run the bot: Telegram polling, the mail watcher and the periodic jobs as tasks
+    of one event loop, until SIGTERM or SIGINT.
+    """
+    global bot, db, attachment_store, image_pool
+    logging.info("Bot started")
+    mail_alive()
+    bot = create_bot()
+    db = MailBotDB(DB_FILE)
+    os.makedirs(PICTURES_FOLDER, exist_ok=True)
+    attachment_store = AttachmentStore(
+        PICTURES_FOLDER, db,
+        max_bytes=int(PICTURES_MAX_MB) * 1024 * 1024 if PICTURES_MAX_MB else None,
+        max_age_days=int(PICTURES_MAX_AGE_DAYS) if PICTURES_MAX_AGE_DAYS else None)
+    # Spawned rather than forked, the bot already runs threads that a fork would copy mid-work
+    image_pool = ProcessPoolExecutor(max(1, IMAGE_WORKERS), mp_context=multiprocessing.get_context('spawn'))
+    start_metrics()
+    update_authorized_chats()
+    db.prune_processed_emails(PROCESSED_RETENTION_DAYS)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    polling_task = asyncio.create_task(bot.polling(non_stop=True, skip_pending=True), name='polling')
+    mail_task = asyncio.create_task(watch_mail(stop), name='mail')
+    sender_task = asyncio.create_task(run_sender(), name='sender')
+    jobs = [
+        asyncio.create_task(run_every(60, update_authorized_chats)),
+        asyncio.create_task(run_every(3600, lambda: asyncio.to_thread(attachment_store.evict), 'evict_attachments')),
+        asyncio.create_task(run_every(86400, lambda: asyncio.to_thread(
+            db.prune_processed_emails, PROCESSED_RETENTION_DAYS), 'prune_processed_emails')),
+        asyncio.create_task(run_every(heartbeat.interval(), lambda: check_liveness(polling_task, mail_task, sender_task),
+                                      'check_liveness')),
+    ]
+    if METRICS_LOG_INTERVAL:
+        jobs.append(asyncio.create_task(run_every(METRICS_LOG_INTERVAL * 60, log_metrics)))
+    heartbeat.beat()
+    heartbeat.notify('READY=1')
+
+    await stop.wait()
+    logging.info("Shutting down")
+    heartbeat.notify('STOPPING=1')
+
+    # Stop the IMAP session first, then give the tasks a moment to finish their work
+    mail_stop.set()
+    interrupt_mailbox()
+    for task in jobs:
+        task.cancel()
+    polling_task.cancel()
+    sender_task.cancel()  # Unsent jobs stay in the outbox
+    await asyncio.wait([mail_task, polling_task, sender_task, *jobs], timeout=SHUTDOWN_TIMEOUT)
+    mail_task.cancel()
+    image_pool.shutdown(wait=False, cancel_futures=True)
+    await bot.close_session()
+    db.close()
+    logging.info("Bot stopped")
+
+def run_bot():
+    logging.basicConfig(filename='mail_bot.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        encoding='utf-8')
+    asyncio.run(main())
 
 if __name__ == "__main__":
-    run_bot()
\ No newline at end of file
+    run_bot()
@@ -0,0 +1,47 @@
+"""
+Image preparation for Telegram uploads, run in worker processes of the mail bot.
+
+The spawned worker processes import bot.py again, which only defines its functions
+and settings at import; the bot, database and logging are set up in bot.main().
+"""
+import io
+import os
+
+from PIL import Image, ImageOps # type: ignore
+
+def shrink_image(path, max_side, quality, shrink_above):
+    """
+    Downscale and re-encode a stored image as JPEG if it is larger than needed.
+    The file itself is not changed.
+
+    :param path: Path of the stored image
+    :param max_side: Longest side in pixels after downscaling
+    :param quality: JPEG quality (1-95)
+    :param shrink_above: Images that fit into max_side and are not larger than this
+                         many bytes are left as they are
+    :return: The JPEG bytes, or None if the original should be uploaded
+    """
+    size = os.path.getsize(path)
+    with Image.open(path) as image:
+        if getattr(image, 'is_animated', False):
+            return None
+        fits = max(image.size) <= max_side
+        if fits and size <= shrink_above:
+            return None
+
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode not in ('RGB', 'L'):
+            # JPEG has no transparency, put transparent areas on white
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+
+    payload = output.getvalue()
+    if fits and len(payload) >= size:
+        return None
+    return payload
@@ -0,0 +1,217 @@
+"""
+Minimal in-process metrics for the mail bot: counters, gauges and histograms with
+labels, rendered in the Prometheus text format by a small HTTP server.
+
+Only the standard library is used, so the bot does not need prometheus_client.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class: a named metric with one value per combination of label values."""
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, **extra):
+        return {**dict(zip(self.labelnames, key)), **extra}
+
+    def samples(self):
+        """Yield (name, labels, value) for every sample of the metric."""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, self._labels(key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{_format_labels(labels)} {_format_value(value)}'
+                  for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down, or is computed when the metrics are read."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function, **labels):
+        """Compute the value by calling function() every time the metrics are read."""
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def samples(self):
+        yield from super().samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            try:
+                yield self.name, self._labels(key), function()
+            except Exception:
+                continue
+
+
+class Histogram(Metric):
+    """Distribution of observed values (latencies in seconds) in cumulative buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', self._labels(key, le=_format_value(float(bound))), cumulative
+            yield f'{self.name}_sum', self._labels(key), total
+            yield f'{self.name}_count', self._labels(key), cumulative
+
+    def stats(self):
+        """Yield (labels, count, sum) for every label combination."""
+        with self._lock:
+            items = [(key, sum(counts), total) for key, (counts, total) in self._values.items()]
+        for key, count, total in items:
+            yield self._labels(key), count, total
+
+
+class Registry:
+    """Collection of metrics that can be rendered or summarised together."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+    def summary(self):
+        """Short human readable lines for the log: counters and gauges with their value,
+        histograms with count and average."""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                for labels, count, total in metric.stats():
+                    average = total / count if count else 0.0
+                    lines.append(f"{metric.name}{_format_labels(labels)} count={count} avg={average:.3f}s")
+            else:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+REGISTRY = Registry()
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serve the metrics at http://host:port/metrics from a daemon thread.
+
+    :return: The running server, call shutdown() to stop it
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are not worth a log line
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -4,6 +4,10 @@ import os
 import time
 import subprocess
 import logging
+import select
+import struct
+import ctypes
+import ctypes.util
 
 # Get the directory of the script
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -14,44 +18,91 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     filename=LOG_FILE)
 
-# Path to the log file we're monitoring
-MAIL_BOT_LOG_FILE = os.path.join(SCRIPT_DIR, 'mail_bot.log')
+# Heartbeat file touched by the bot every few seconds while it is healthy
+HEARTBEAT_FILE = os.path.join(SCRIPT_DIR, 'mail_bot.heartbeat')
 
 # The name of the service we're monitoring
 SERVICE_NAME = 'telegram-mail-bot.service'
 
-def get_service_start_time():
-    """Get the start time of the service."""
-    try:
-        result = subprocess.run(['systemctl', 'show', SERVICE_NAME, '--property=ActiveEnterTimestamp'],
-                                capture_output=True, text=True, check=True)
-        timestamp = result.stdout.split('=')[1].strip()
-        return int(time.mktime(time.strptime(timestamp, '%a %Y-%m-%d %H:%M:%S %Z')))
-    except Exception as e:
-        logging.error(f"Error getting service start time: {e}")
-        return None
-
-def get_last_log_time():
-    """Get the timestamp of the last log entry."""
-    try:
-        return os.path.getmtime(MAIL_BOT_LOG_FILE)
-    except FileNotFoundError:
-        logging.error(f"Log file not found: {MAIL_BOT_LOG_FILE}")
-        return None
+HEARTBEAT_TIMEOUT = 60  # Restart if no heartbeat arrived for this many seconds
+STARTUP_GRACE = 120  # Seconds given to the bot to send its first heartbeat after a (re)start
+FALLBACK_CHECK_INTERVAL = 5  # Seconds between checks when inotify is not available
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+class HeartbeatWatcher:
+    """
+    Wait for changes of the heartbeat file with inotify. The directory is watched,
+    so the file may be created or replaced. Falls back to checking the file's
+    mtime every few seconds where inotify is not available.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.name = os.fsencode(os.path.basename(path))
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(os.path.dirname(path)), mask) < 0:
+                error = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(error, os.strerror(error))
+            self.fd = fd
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify not available ({e}), checking the heartbeat file every "
+                            f"{FALLBACK_CHECK_INTERVAL} seconds")
+
+    def last_beat(self):
+        """Modification time of the heartbeat file, or None if it does not exist."""
+        try:
+            return os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return None
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for a heartbeat. Returns True if one arrived."""
+        if self.fd is None:
+            before = self.last_beat()
+            time.sleep(min(timeout, FALLBACK_CHECK_INTERVAL))
+            return self.last_beat() != before
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return False
+        data = os.read(self.fd, 64 * 1024)
+        beat = False
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            beat = beat or name == self.name
+        return beat
 
 def restart_service():
     """Restart the service."""
     try:
         # Check if the service exists
         subprocess.run(['systemctl', 'status', SERVICE_NAME], check=True, capture_output=True)
-        
+
         # Try restarting without sudo first
         try:
             subprocess.run(['systemctl', 'restart', SERVICE_NAME], check=True)
         except subprocess.CalledProcessError:
             # If that fails, try with sudo
             subprocess.run(['sudo', 'systemctl', 'restart', SERVICE_NAME], check=True)
-        
+
         logging.info(f"Restarted {SERVICE_NAME}")
     except subprocess.CalledProcessError as e:
         logging.error(f"Failed to restart {SERVICE_NAME}: {e}")
@@ -59,23 +110,26 @@ def restart_service():
 
 def main():
     logging.info("Monitor script started")
-    while True:
-        service_start_time = get_service_start_time()
-        last_log_time = get_last_log_time()
+    watcher = HeartbeatWatcher(HEARTBEAT_FILE)
 
-        if service_start_time is None or last_log_time is None:
-            time.sleep(60)  # Wait for a minute and try again
-            continue
+    # The deadline is kept on the monotonic clock; the file's mtime only seeds it
+    now = time.time()
+    last_beat = watcher.last_beat()
+    remaining = HEARTBEAT_TIMEOUT - (now - last_beat) if last_beat else 0
+    deadline = time.monotonic() + max(remaining, STARTUP_GRACE)
 
-        current_time = time.time()
-        time_since_log = current_time - last_log_time
-        time_since_start = current_time - service_start_time
+    while True:
+        if watcher.wait(deadline - time.monotonic()):
+            deadline = time.monotonic() + HEARTBEAT_TIMEOUT
+            continue
+        if time.monotonic() < deadline:
+            continue
 
-        if time_since_log > 600 and time_since_start > 600:  # 10 minutes
-            logging.warning(f"No log activity for {time_since_log:.2f} seconds. Restarting service.")
-            restart_service()
-        
-        time.sleep(60)  # Check every minute
+        last_beat = watcher.last_beat()
+        silence = f"{time.time() - last_beat:.0f} seconds" if last_beat else "ever"
+        logging.warning(f"No heartbeat for {silence}. Restarting service.")
+        restart_service()
+        deadline = time.monotonic() + STARTUP_GRACE
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
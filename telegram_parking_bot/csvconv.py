@@ -2,22 +2,59 @@ import os
 import pandas as pd
 from datetime import datetime
 import re
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import sqlite3
+import threading
+import time
 import email
 import imaplib
 import email.header
 from email.header import decode_header
 from dotenv import load_dotenv
 import base64
+import quopri
+import urllib.parse
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import numpy as np
+from plate_matching import PlateReconciler, paired_plates
+from event_store import EventStore
+from interval_engine import IntervalEngine
 
 load_dotenv()
 
 os.makedirs('./csvdata', exist_ok=True)
 os.makedirs('./csvbymonth', exist_ok=True)
 
+MANIFEST_FILE = './csvbymonth/manifest.json'
+PUBLISH_STATE_FILE = './csvbymonth/published.json'
+PLATE_MAPPING_FILE = 'plate_mapping.txt'
+PLATE_MAX_DISTANCE = int(os.getenv('PLATE_MAX_DISTANCE', 1))  # Edits allowed when matching a misread plate, 0 disables
+PLATE_MIN_READS = int(os.getenv('PLATE_MIN_READS', 3))  # Plates read this often in a month count as real
+VISIT_MAX_DAYS = float(os.getenv('VISIT_MAX_DAYS', 31))  # Entries without an exit for longer are abandoned
+SOURCE_COLUMN = 'Файл'  # Source file of each stored event, never exported
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', os.cpu_count() or 1))
+BUILD_WORKERS = int(os.getenv('BUILD_WORKERS', os.cpu_count() or 1))
+
+EXPORT_COLUMNS = ['Номерной знак', 'Белый список', 'Время мом. снимка', 'ТС спереди или сзади']
+EXPORT_DTYPES = {
+    'Номерной знак': 'category',
+    'Белый список': 'category',
+    'ТС спереди или сзади': 'category'
+}
+CHANNELS = ['CH01', 'CH02', 'Unknown']
+INTERVAL_COLUMNS = ['Номерной знак', 'Количество проездов', 'Суммарное время (мин)', 'Детали проездов']
+
+SENT_FOLDER = '"[Gmail]/Sent Mail"'
+MAIL_SINCE = os.getenv('MAIL_SINCE')  # e.g. 01-Jan-2024, used while there is no UID watermark yet
+FETCH_BATCH = 200  # Messages per FETCH command
+ACCOUNT_TIMEOUT = int(os.getenv('ACCOUNT_TIMEOUT', 600))  # Seconds one mailbox may take
+COMMIT_BATCH = 100  # Processed emails per commit
+PROCESSED_RETENTION_DAYS = int(os.getenv('PROCESSED_RETENTION_DAYS', 365))  # Days processed Message-IDs are kept
+VACUUM_AFTER_ROWS = 1000  # Compact processed_emails.db after pruning at least this many rows
+
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SERVICE_ACCOUNT_FILE = 'service-account-key.json'
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
@@ -38,7 +75,7 @@ def format_duration(minutes):
     remaining_hours = hours % 24
     return f"{days} д. {remaining_hours} ч. {remaining_minutes} мин"
 
-def load_plate_mappings(filename='plate_mapping.txt'):
+def load_plate_mappings(filename=PLATE_MAPPING_FILE):
     mappings = {}
     try:
         with open(filename, 'r', encoding='utf-8') as f:
@@ -53,215 +90,675 @@ def load_plate_mappings(filename='plate_mapping.txt'):
         print(f"Warning: {filename} not found")
     return mappings
 
+def sheets_dry_run():
+    """True if SHEETS_DRY_RUN is set, publishing then goes to fake_sheets.FakeSheetsService"""
+    return bool(os.getenv('SHEETS_DRY_RUN'))
+
 def setup_sheets_api():
+    if sheets_dry_run():
+        from fake_sheets import FakeSheetsService
+        return FakeSheetsService(verbose=True)
     creds = service_account.Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE, scopes=SCOPES)
     return build('sheets', 'v4', credentials=creds)
 
-def manage_sheet(service, sheet_name):
-    try:
-        metadata = service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-        if not any(sheet['properties']['title'] == sheet_name for sheet in metadata.get('sheets', '')):
-            body = {
-                'requests': [{
-                    'addSheet': {
-                        'properties': {'title': sheet_name}
-                    }
-                }]
-            }
-            service.spreadsheets().batchUpdate(
-                spreadsheetId=SPREADSHEET_ID,
-                body=body
+def sheet_values(data):
+    """Convert an intervals table to the rows written to its sheet"""
+    if 'Суммарное время (мин)' in data.columns:
+        data = data.copy()
+        data['Суммарное время'] = data['Суммарное время (мин)'].apply(format_duration)
+        data = data.drop('Суммарное время (мин)', axis=1)
+
+    values = [data.columns.values.tolist()] + data.values.tolist()
+    return [['' if pd.isna(x) else x for x in row] for row in values]
+
+class SheetsPublisher:
+    """Publish monthly sheets with a fixed number of Sheets API calls per run.
+
+    Spreadsheet metadata is read once, missing sheets are created in one batchUpdate and
+    all changed sheets are cleared and written with one values().batchClear and one
+    values().batchUpdate. Sheets whose content hash matches the last published one
+    (kept in PUBLISH_STATE_FILE) are skipped. With save_state=False the hashes are only
+    kept in memory, for publishing to a service other than the real spreadsheet.
+    """
+
+    def __init__(self, service, spreadsheet_id, state_file=PUBLISH_STATE_FILE, save_state=True):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.state_file = state_file
+        self.save_state = save_state
+        try:
+            with open(state_file, 'r', encoding='utf-8') as f:
+                self.published = json.load(f)
+        except FileNotFoundError:
+            self.published = {}
+
+    @staticmethod
+    def content_hash(values):
+        return hashlib.sha256(json.dumps(values, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+    def publish(self, sheets):
+        """Publish {sheet_name: values}; returns the names of the sheets that were written"""
+        hashes = {name: self.content_hash(values) for name, values in sheets.items()}
+        changed = {name: values for name, values in sheets.items() if self.published.get(name) != hashes[name]}
+        for name in sheets.keys() - changed.keys():
+            print(f"Unchanged sheet: {name}")
+        if not changed:
+            return []
+
+        spreadsheets = self.service.spreadsheets()
+        metadata = spreadsheets.get(spreadsheetId=self.spreadsheet_id, fields='sheets.properties.title').execute()
+        existing = {sheet['properties']['title'] for sheet in metadata.get('sheets', [])}
+        missing = [name for name in changed if name not in existing]
+        if missing:
+            spreadsheets.batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'requests': [{'addSheet': {'properties': {'title': name}}} for name in missing]}
             ).execute()
-        return True
-    except Exception as e:
-        print(f"Sheet management error ({sheet_name}): {e}")
-        return False
 
-def update_sheet_content(service, sheet_name, data):
-    try:
-        if 'Суммарное время (мин)' in data.columns:
-            data['Суммарное время'] = data['Суммарное время (мин)'].apply(format_duration)
-            data = data.drop('Суммарное время (мин)', axis=1)
-
-        values = [data.columns.values.tolist()] + data.values.tolist()
-        values = [['' if pd.isna(x) else x for x in row] for row in values]
-        
-        range_name = f'{sheet_name}!A1:Z'
-        service.spreadsheets().values().clear(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range_name
+        spreadsheets.values().batchClear(
+            spreadsheetId=self.spreadsheet_id,
+            body={'ranges': [f'{name}!A1:Z' for name in changed]}
         ).execute()
-        
-        service.spreadsheets().values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f'{sheet_name}!A1',
-            valueInputOption='RAW',
-            body={'values': values}
+        spreadsheets.values().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={
+                'valueInputOption': 'RAW',
+                'data': [{'range': f'{name}!A1', 'values': values} for name, values in changed.items()]
+            }
         ).execute()
-        return True
-    except Exception as e:
-        print(f"Sheet update error ({sheet_name}): {e}")
-        return False
 
-def setup_email_db():
-    conn = sqlite3.connect('processed_emails.db')
+        self.published.update({name: hashes[name] for name in changed})
+        if not self.save_state:
+            return list(changed)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.published, f, indent=1)
+        os.replace(tmp_file, self.state_file)
+        return list(changed)
+
+def setup_email_db(path='processed_emails.db'):
+    conn = sqlite3.connect(path, check_same_thread=False)
     conn.execute('''
         CREATE TABLE IF NOT EXISTS processed_emails
         (message_id TEXT PRIMARY KEY, 
          subject TEXT,
          date TEXT,
-         email_account TEXT)
+         email_account TEXT,
+         processed_at REAL)
+    ''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(processed_emails)')]
+    if 'processed_at' not in columns:
+        # Rows from before retention are kept for one retention period from now
+        conn.execute('ALTER TABLE processed_emails ADD COLUMN processed_at REAL')
+        conn.execute('UPDATE processed_emails SET processed_at = ?', (time.time(),))
+    conn.execute('CREATE INDEX IF NOT EXISTS processed_emails_processed_at ON processed_emails (processed_at)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS mailbox_state
+        (email_account TEXT,
+         folder TEXT,
+         uidvalidity INTEGER,
+         last_uid INTEGER,
+         PRIMARY KEY (email_account, folder))
     ''')
     conn.commit()
     return conn
 
-def check_processed_email(conn, message_id):
-    return conn.execute('SELECT 1 FROM processed_emails WHERE message_id = ?', 
-                       (message_id,)).fetchone() is not None
+class ProcessedEmailStore:
+    """Single writer for processed_emails.db shared by the mailbox sync threads.
 
-def record_processed_email(conn, message_id, subject, date, account):
-    conn.execute('INSERT INTO processed_emails VALUES (?, ?, ?, ?)',
-                (message_id, subject, date, account))
-    conn.commit()
+    All accounts use one connection behind a lock. Processed emails are committed in
+    batches of COMMIT_BATCH rows, watermarks are committed together with everything
+    recorded before them.
 
-def fetch_email_attachments(email_account, password):
-    mail = imaplib.IMAP4_SSL('imap.gmail.com')
-    mail.login(email_account, password)
-    mail.select('"[Gmail]/Sent Mail"')
+    Message-IDs older than the retention period are pruned when the store is opened
+    and the remaining ones are kept in memory, so lookups never touch the disk.
+    """
 
-    conn = setup_email_db()
-    _, messages = mail.search(None, 'ALL')
+    def __init__(self, path='processed_emails.db', retention_days=PROCESSED_RETENTION_DAYS):
+        self._conn = setup_email_db(path)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.prune(retention_days)
+        self._processed = {row[0] for row in self._conn.execute('SELECT message_id FROM processed_emails')}
 
-    for num in messages[0].split():
-        _, msg_data = mail.fetch(num, '(RFC822)')
-        email_msg = email.message_from_bytes(msg_data[0][1])
-        
-        if check_processed_email(conn, email_msg['Message-ID']):
-            continue
+    def prune(self, retention_days):
+        """Delete Message-IDs processed before the retention period or before MAIL_SINCE,
+        which are outside the IMAP search window. Compacts the file after large deletes.
+        Returns the number of deleted rows."""
+        cutoff = time.time() - retention_days * 86400
+        if MAIL_SINCE:
+            cutoff = max(cutoff, datetime.strptime(MAIL_SINCE, '%d-%b-%Y').timestamp())
+        with self._lock:
+            removed = self._conn.execute('DELETE FROM processed_emails WHERE processed_at < ?', (cutoff,)).rowcount
+            self._commit()
+            if removed >= VACUUM_AFTER_ROWS:
+                self._conn.execute('VACUUM')
+        if removed:
+            print(f"Pruned {removed} processed emails older than the retention period")
+        return removed
 
-        for part in email_msg.walk():
-            if part.get_content_maintype() == 'multipart' or not part.get('Content-Disposition'):
-                continue
+    def check_processed_emails(self, message_ids):
+        """Return the subset of message_ids already processed"""
+        with self._lock:
+            return {message_id for message_id in message_ids if message_id and message_id in self._processed}
+
+    def record_processed_email(self, message_id, subject, date, account):
+        with self._lock:
+            self._processed.add(message_id)
+            self._conn.execute('INSERT OR IGNORE INTO processed_emails VALUES (?, ?, ?, ?, ?)',
+                               (message_id, subject, date, account, time.time()))
+            self._pending += 1
+            if self._pending >= COMMIT_BATCH:
+                self._commit()
+
+    def get_mailbox_state(self, account, folder):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT uidvalidity, last_uid FROM mailbox_state WHERE email_account = ? AND folder = ?',
+                (account, folder)).fetchone()
+
+    def set_mailbox_state(self, account, folder, uidvalidity, last_uid):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO mailbox_state VALUES (?, ?, ?, ?)',
+                               (account, folder, uidvalidity, last_uid))
+            self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[]+(?:\[[^\]]*\])?))')
+
+def parse_fetch_response(data):
+    """Parse an imaplib FETCH response into one {attribute: value} dict per message.
+    Lists become nested lists, NIL becomes None and literals become bytes."""
+    stack = [[]]
+    for item in data:
+        text, literal = (re.sub(rb'\{\d+\}$', b'', item[0]), item[1]) if isinstance(item, tuple) else (item, None)
+        for match in IMAP_TOKEN_RE.finditer(text or b''):
+            open_paren, close_paren, quoted, atom = match.groups()
+            if open_paren:
+                stack.append([])
+            elif close_paren and len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+            elif quoted is not None:
+                stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted))
+            elif atom is not None:
+                stack[-1].append(None if atom.upper() == b'NIL' else atom)
+        if literal is not None:
+            stack[-1].append(literal)
+    return [dict(zip(item[::2], item[1::2])) for item in stack[0] if isinstance(item, list)]
+
+def _params(pairs):
+    if not isinstance(pairs, list):
+        return {}
+    return {pairs[i].decode().lower(): pairs[i + 1] for i in range(0, len(pairs) - 1, 2)
+            if isinstance(pairs[i], bytes) and isinstance(pairs[i + 1], bytes)}
+
+def _decode_filename(params):
+    if params.get('filename*') or params.get('name*'):
+        # RFC 2231 extended value: charset'language'percent-encoded-text
+        raw = (params.get('filename*') or params.get('name*')).decode('ascii', 'replace')
+        charset, _, encoded = raw.split("'", 2) if raw.count("'") >= 2 else ('', '', raw)
+        return urllib.parse.unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+    for key in ('filename', 'name'):
+        if params.get(key):
+            value = params[key].decode('utf-8', 'replace')
+            return str(email.header.make_header(decode_header(value)))
+    return None
+
+def attachment_parts(structure, prefix=''):
+    """List (section, filename, encoding) of the parts of a BODYSTRUCTURE that have
+    a Content-Disposition and a file name"""
+    if structure and isinstance(structure[0], list):
+        parts = []
+        for index, child in enumerate(structure):
+            if not isinstance(child, list):
+                break
+            parts.extend(attachment_parts(child, f"{prefix}{index + 1}."))
+        return parts
+
+    disposition = None
+    for ext in structure[7:]:
+        if isinstance(ext, list) and len(ext) == 2 and isinstance(ext[0], bytes):
+            disposition = ext
+            break
+    if disposition is None:
+        return []
+    filename = _decode_filename(_params(disposition[1])) or _decode_filename(_params(structure[2]))
+    if not filename:
+        return []
+    encoding = (structure[5] or b'7BIT').decode().upper()
+    return [(prefix.rstrip('.') or '1', filename, encoding)]
+
+def fetch_parts(mail, uid, parts):
+    """Download only the given parts of a message with BODY.PEEK[section]"""
+    sections = ' '.join(f'BODY.PEEK[{section}]' for section, _, _ in parts)
+    _, data = mail.uid('FETCH', uid, f'({sections})')
+    raw = {}
+    for item in data:
+        if isinstance(item, tuple):
+            if match := re.search(rb'BODY\[([\d.]+)\]\s*\{\d+\}$', item[0]):
+                raw[match.group(1).decode()] = item[1]
+    for section, filename, encoding in parts:
+        payload = raw.get(section, b'')
+        if encoding == 'BASE64':
+            payload = base64.b64decode(payload)
+        elif encoding == 'QUOTED-PRINTABLE':
+            payload = quopri.decodestring(payload)
+        yield filename, payload
+
+def save_attachment(filename, payload):
+    """Write an attachment to ./csvdata under a temporary name and rename it into
+    place, so the scan never sees a partly written export"""
+    path = os.path.join('./csvdata', filename)
+    temp_path = f'{path}.part'
+    with open(temp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(temp_path, path)
+
+def fetch_email_attachments(email_account, password, store, deadline=None):
+    """Download new .CSV attachments from the Sent Mail folder of one account.
+
+    Only UIDs above the stored watermark are searched (or SINCE MAIL_SINCE / ALL on the
+    first run). Headers and BODYSTRUCTURE are fetched in batches, processed Message-IDs
+    are checked with one query per batch and only the .CSV parts are downloaded.
+    Once the monotonic deadline has passed the sync stops before the next message, the
+    watermark is kept at the last handled one and the IMAP connection is closed. The
+    socket timeout is shortened to the time left, so a stalled server cannot hold the
+    thread past the deadline either.
+    """
+    mail = imaplib.IMAP4_SSL('imap.gmail.com', timeout=ACCOUNT_TIMEOUT)
+    try:
+        mail.login(email_account, password)
+        mail.select(SENT_FOLDER)
+        uidvalidity = int(mail.response('UIDVALIDITY')[1][0])
+
+        state = store.get_mailbox_state(email_account, SENT_FOLDER)
+        if state and state[0] == uidvalidity:
+            last_uid = state[1]
+            criteria = f'UID {last_uid + 1}:*'
+        else:
+            last_uid = 0
+            criteria = f'SINCE {MAIL_SINCE}' if MAIL_SINCE else 'ALL'
+
+        _, messages = mail.uid('SEARCH', None, criteria)
+        # A UID range ending in * always matches the newest message, so filter again
+        uids = sorted((uid.decode() for uid in messages[0].split() if int(uid) > last_uid), key=int)
+
+        def timed_out():
+            if deadline is None:
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            mail.sock.settimeout(min(ACCOUNT_TIMEOUT, remaining))
+            return False
+
+        for start in range(0, len(uids), FETCH_BATCH):
+            if timed_out():
+                print(f"Mailbox {email_account} timed out, continuing next run")
+                return
+            batch = uids[start:start + FETCH_BATCH]
+            _, data = mail.uid('FETCH', ','.join(batch),
+                               '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID SUBJECT DATE)] BODYSTRUCTURE)')
+            fetched = []
+            for attrs in parse_fetch_response(data):
+                header = next((value for key, value in attrs.items() if key.startswith(b'BODY[HEADER')), b'')
+                fetched.append((attrs[b'UID'].decode(), email.message_from_bytes(header or b''),
+                                attrs.get(b'BODYSTRUCTURE')))
+            fetched.sort(key=lambda item: int(item[0]))
+
+            processed = store.check_processed_emails([headers['Message-ID'] for _, headers, _ in fetched])
+            for uid, headers, structure in fetched:
+                if headers['Message-ID'] in processed or not structure:
+                    continue
+
+                csv_parts = [part for part in attachment_parts(structure) if part[1].upper().endswith('.CSV')]
+                if not csv_parts:
+                    continue
+
+                if timed_out():
+                    # Everything below this message is done, the rest is fetched next run
+                    store.set_mailbox_state(email_account, SENT_FOLDER, uidvalidity,
+                                            max(last_uid, int(uid) - 1))
+                    print(f"Mailbox {email_account} timed out, continuing next run")
+                    return
+
+                for filename, payload in fetch_parts(mail, uid, csv_parts):
+                    save_attachment(filename, payload)
+
+                store.record_processed_email(headers['Message-ID'], 
+                                             headers['subject'], headers['date'], 
+                                             email_account)
+
+            last_uid = max(last_uid, max(int(uid) for uid in batch))
+            store.set_mailbox_state(email_account, SENT_FOLDER, uidvalidity, last_uid)
 
-            filename = part.get_filename()
-            if filename and filename.upper().endswith('.CSV'):
-                if decode_header(filename)[0][1]:
-                    filename = decode_header(filename)[0][0].decode(decode_header(filename)[0][1])
+        if not uids:
+            store.set_mailbox_state(email_account, SENT_FOLDER, uidvalidity, last_uid)
+    finally:
+        try:
+            if mail.state == 'SELECTED':
+                mail.close()
+            mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            mail.shutdown()
 
-                with open(os.path.join('./csvdata', filename), 'wb') as f:
-                    f.write(part.get_payload(decode=True))
-                
-                record_processed_email(conn, email_msg['Message-ID'], 
-                                    email_msg['subject'], email_msg['date'], 
-                                    email_account)
+def load_accounts():
+    """Mail accounts from the environment: every EMAILn with a matching EMAILn_PASSWORD"""
+    numbers = sorted(int(match.group(1)) for key in os.environ if (match := re.fullmatch(r'EMAIL(\d+)', key)))
+    return [(os.getenv(f'EMAIL{n}'), os.getenv(f'EMAIL{n}_PASSWORD')) for n in numbers
+            if os.getenv(f'EMAIL{n}') and os.getenv(f'EMAIL{n}_PASSWORD')]
 
-    mail.close()
-    mail.logout()
-    conn.close()
+def sync_mailboxes(accounts):
+    """Sync all accounts concurrently; a mailbox that takes longer than ACCOUNT_TIMEOUT
+    stops at the deadline so it does not hold up the rest of the run. Returns once
+    every account thread has finished, so nothing writes to ./csvdata afterwards."""
+    if not accounts:
+        return
+    store = ProcessedEmailStore()
+    deadline = time.monotonic() + ACCOUNT_TIMEOUT
+    try:
+        with ThreadPoolExecutor(max_workers=len(accounts)) as executor:
+            futures = {executor.submit(fetch_email_attachments, account, password, store, deadline): account
+                       for account, password in accounts}
+            for future in as_completed(futures):
+                if future.exception():
+                    print(f"Mailbox sync error ({futures[future]}): {future.exception()}")
+    finally:
+        store.close()
 
 def identify_channel(filename):
     ip_match = re.search(r'192\.168\.4\.(\d+)', filename)
     return 'CH01' if ip_match and ip_match.group(1) == '103' else 'CH02' if ip_match and ip_match.group(1) == '104' else 'Unknown'
 
-def process_intervals(df, plate_mappings):
-    intervals_data = []
-    
-    df = df.copy()
-    df['Original_Plate'] = df['Номерной знак']
-    df['Номерной знак'] = df['Номерной знак'].map(lambda x: plate_mappings.get(x, x))
-    
-    for plate in df['Номерной знак'].unique():
-        plate_events = df[df['Номерной знак'] == plate].sort_values('Время мом. снимка')
-        
-        intervals = []
-        start_time = None
-        
-        for _, event in plate_events.iterrows():
-            if event['Канал'] == 'CH01':
-                if not start_time:
-                    start_time = event['Время мом. снимка']
-            elif event['Канал'] == 'CH02' and start_time:
-                duration = (event['Время мом. снимка'] - start_time).total_seconds() / 60
-                intervals.append({
-                    'start': start_time,
-                    'end': event['Время мом. снимка'],
-                    'duration': int(duration)  # Floor rounding
-                })
-                start_time = None
-
-        if intervals:
-            total_minutes = sum(interval['duration'] for interval in intervals)
-            
-            intervals_details = ', '.join([
-                f"({interval['start'].strftime('%Y-%m-%d %H:%M:%S')} -> "
-                f"{interval['end'].strftime('%Y-%m-%d %H:%M:%S')}: "
-                f"{format_duration(interval['duration'])})"
-                for interval in intervals
-            ])
-            
-            intervals_data.append({
-                'Номерной знак': plate,
-                'Количество проездов': len(intervals),
-                'Суммарное время (мин)': total_minutes,
-                'Детали проездов': intervals_details
-            })
-    
-    return pd.DataFrame(intervals_data)
+def process_intervals(df, reconciler):
+    """Pair CH01 entries with CH02 exits for every plate and summarise the visits.
 
-def update_sheets_with_intervals():
-    service = setup_sheets_api()
-    interval_files = [f for f in os.listdir('./csvbymonth') if f.startswith('intervals_')]
-    
-    for file in interval_files:
+    Reference implementation for a single frame of events; main() keeps the visits
+    with IntervalEngine instead, whose reports have the same format.
+
+    Plates are first resolved with `reconciler`, a PlateReconciler or a plain
+    mapping dict from load_plate_mappings.
+
+    Events are sorted once by plate and time. Within a plate the first CH01 opens an
+    interval, further CH01 are ignored while it is open and the next CH02 closes it.
+    Since the state after any event only depends on its channel, an interval closes at
+    every CH02 directly preceded by a CH01 and starts at the first CH01 of that run.
+    """
+    if not isinstance(reconciler, PlateReconciler):
+        reconciler = PlateReconciler(reconciler, PLATE_MAX_DISTANCE, PLATE_MIN_READS)
+    paired = paired_plates(df['Номерной знак'], df['Канал'], df['Время мом. снимка'])
+    plates = reconciler.resolve(df['Номерной знак'], paired=paired)
+
+    # Plate codes follow the order of first appearance, which is the report order
+    codes, uniques = pd.factorize(plates)
+    channels = df['Канал'].to_numpy()
+    keep = (codes >= 0) & np.isin(channels, ['CH01', 'CH02'])
+    codes = codes[keep]
+    times = df['Время мом. снимка'].to_numpy()[keep]
+    entry = channels[keep] == 'CH01'
+
+    order = np.lexsort((times, codes))
+    codes, times, entry = codes[order], times[order], entry[order]
+
+    same_plate = np.r_[False, codes[1:] == codes[:-1]]
+    after_entry = np.r_[False, entry[:-1]] & same_plate
+    opens = entry & ~after_entry
+    closes = ~entry & after_entry
+    if not closes.any():
+        return pd.DataFrame(columns=INTERVAL_COLUMNS)
+
+    # Position of the most recent opening CH01 for every event
+    open_pos = np.maximum.accumulate(np.where(opens, np.arange(len(codes)), 0))
+    starts = pd.Series(times[open_pos[closes]])
+    ends = pd.Series(times[closes])
+    durations = ((ends - starts).dt.total_seconds() / 60).astype('int64')  # Floor rounding
+
+    details = visit_details(starts, ends, durations)
+    intervals = pd.DataFrame({'code': codes[closes], 'duration': durations, 'details': details})
+    summary = intervals.groupby('code', sort=True).agg(
+        count=('duration', 'size'),
+        total=('duration', 'sum'),
+        details=('details', ', '.join))
+
+    return pd.DataFrame({
+        'Номерной знак': uniques[summary.index],
+        'Количество проездов': summary['count'].to_numpy(),
+        'Суммарное время (мин)': summary['total'].to_numpy(),
+        'Детали проездов': summary['details'].to_numpy()
+    }, columns=INTERVAL_COLUMNS)
+
+def visit_details(starts, ends, durations):
+    """Return the '(entry -> exit: duration)' text of every visit"""
+    duration_text = durations.map({m: format_duration(m) for m in durations.unique()})
+    return ('(' + starts.dt.strftime('%Y-%m-%d %H:%M:%S') + ' -> '
+            + ends.dt.strftime('%Y-%m-%d %H:%M:%S') + ': ' + duration_text + ')')
+
+def month_intervals_report(engine, month_key):
+    """Intervals report of one month, in the format of process_intervals, from the
+    visits kept by the interval engine"""
+    visits = engine.month_intervals(month_key)
+    if not len(visits):
+        return pd.DataFrame(columns=INTERVAL_COLUMNS)
+    totals = engine.month_totals(month_key)
+    details = visit_details(visits['entry'], visits['exit'], visits['minutes'])
+    details = details.groupby(visits['plate'].to_numpy(), sort=False).agg(', '.join)
+    return pd.DataFrame({
+        'Номерной знак': totals['plate'].to_numpy(),
+        'Количество проездов': totals['visits'].to_numpy(),
+        'Суммарное время (мин)': totals['minutes'].to_numpy(),
+        'Детали проездов': details.reindex(totals['plate']).to_numpy()
+    }, columns=INTERVAL_COLUMNS)
+
+def update_sheets_with_intervals(months=None):
+    """Publish intervals_YYYY-MM.csv files to Google Sheets, all of them or only the given months.
+    Returns the months that could not be published."""
+    sheets = {}
+    for file in os.listdir('./csvbymonth'):
         if match := re.search(r'intervals_(\d{4}-\d{2})\.csv', file):
+            if months is not None and match.group(1) not in months:
+                continue
             sheet_name = datetime.strptime(match.group(1), '%Y-%m').strftime('%m.%Y')
             df = pd.read_csv(f'./csvbymonth/{file}', encoding='utf-8-sig')
-            
-            if manage_sheet(service, sheet_name):
-                if update_sheet_content(service, sheet_name, df):
-                    print(f"Updated sheet: {sheet_name}")
-                else:
-                    print(f"Failed to update: {sheet_name}")
+            sheets[sheet_name] = sheet_values(df)
+    if not sheets:
+        return set()
+
+    # A dry run leaves the publish state alone and the months unpublished for the next real run
+    dry_run = sheets_dry_run()
+    try:
+        publisher = SheetsPublisher(setup_sheets_api(), SPREADSHEET_ID, save_state=not dry_run)
+        for sheet_name in publisher.publish(sheets):
+            print(f"Updated sheet: {sheet_name}")
+        if dry_run:
+            return {datetime.strptime(name, '%m.%Y').strftime('%Y-%m') for name in sheets}
+        return set()
+    except Exception as e:
+        print(f"Sheet update error: {e}")
+        return {datetime.strptime(name, '%m.%Y').strftime('%Y-%m') for name in sheets}
+
+def file_month(filename):
+    """Return the YYYY-MM month of a camera export from the date in its name, or None"""
+    if date_match := re.search(r'(\d{4}-\d{2}-\d{2})', filename):
+        return datetime.strptime(date_match.group(1), '%Y-%m-%d').strftime('%Y-%m')
+    return None
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest():
+    try:
+        with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'files': {}, 'plate_mapping': None}
+
+def save_manifest(manifest):
+    tmp_file = MANIFEST_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_file, MANIFEST_FILE)
+
+def scan_sources(manifest):
+    """Compare ./csvdata with the manifest.
+
+    Files whose size and mtime match the manifest are taken as unchanged; otherwise the
+    content hash decides. Returns the new manifest entries, the new or changed files
+    and the files that disappeared.
+    """
+    known = manifest['files']
+    entries, changed = {}, []
+    for file in [f for f in os.listdir('./csvdata') if f.endswith('.CSV')]:
+        month_key = file_month(file)
+        if not month_key:
+            continue
+        stat = os.stat(f'./csvdata/{file}')
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'month': month_key}
+        previous = known.get(file)
+        if previous and previous['size'] == entry['size'] and previous['mtime'] == entry['mtime']:
+            entry['sha256'] = previous['sha256']
+        else:
+            entry['sha256'] = file_hash(f'./csvdata/{file}')
+            if not previous or previous['sha256'] != entry['sha256']:
+                changed.append(file)
+        entries[file] = entry
+    removed = [file for file in known if file not in entries]
+    return entries, changed, removed
+
+def read_camera_export(file):
+    """Read one camera export from ./csvdata into the columns used for the reports.
+
+    Only the needed columns are read, text columns become categoricals and the
+    snapshot time is parsed while reading.
+    """
+    df = pd.read_csv(f'./csvdata/{file}', encoding='utf-8', usecols=EXPORT_COLUMNS,
+                     dtype=EXPORT_DTYPES, parse_dates=['Время мом. снимка'])
+    df = df[df['Номерной знак'] != 'Не лицензировано']
+    
+    df = df[EXPORT_COLUMNS].reset_index(drop=True)
+    df.insert(0, 'Канал', pd.Categorical([identify_channel(file)] * len(df), categories=CHANNELS))
+    df[SOURCE_COLUMN] = pd.Categorical([file] * len(df))
+    return df
+
+def read_camera_exports(files):
+    """Parse camera exports in parallel worker processes, returns {file: DataFrame}"""
+    if INGEST_WORKERS <= 1 or len(files) <= 1:
+        return {file: read_camera_export(file) for file in files}
+    with ProcessPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+        return dict(zip(files, executor.map(read_camera_export, files, chunksize=4)))
+
+def export_month_data(month_key, df):
+    """Write data_YYYY-MM.csv with the events of one month"""
+    df = df.drop(columns=SOURCE_COLUMN, errors='ignore')
+    df['Время мом. снимка'] = pd.to_datetime(df['Время мом. снимка'])
+    df_export = df.sort_values(['Номерной знак', 'Время мом. снимка'])
+    df_export['Время мом. снимка'] = df_export['Время мом. снимка'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    df_export.to_csv(f'./csvbymonth/data_{month_key}.csv', index=False, encoding='utf-8-sig')
+
+def write_month_intervals(month_key, intervals):
+    """Write intervals_YYYY-MM.csv for one month"""
+    intervals.to_csv(f'./csvbymonth/intervals_{month_key}.csv', index=False, encoding='utf-8-sig')
+
+def build_month(month_key, export_data):
+    """Write intervals_YYYY-MM.csv, and data_YYYY-MM.csv if export_data, for one month.
+
+    Runs in a worker process and reads the month from the event store itself, so only
+    the month key is passed in. The store is opened read-only, the workers never take
+    the write lock. Returns (month_key, events or None, visits, seconds).
+    """
+    start = time.perf_counter()
+    store = EventStore(readonly=True)
+    try:
+        events = None
+        if export_data:
+            df = store.month_events(month_key)
+            export_month_data(month_key, df)
+            events = len(df)
+        intervals = month_intervals_report(IntervalEngine(store, None), month_key)
+        write_month_intervals(month_key, intervals)
+    finally:
+        store.close()
+    return month_key, events, int(intervals['Количество проездов'].sum()), time.perf_counter() - start
+
+def build_months(months, export_data):
+    """Build the reports of `months` in parallel worker processes, data_ files only for
+    the months in `export_data`. Returns the results of build_month in month order."""
+    months = sorted(months)
+    exports = [month_key in export_data for month_key in months]
+    if BUILD_WORKERS <= 1 or len(months) <= 1:
+        return [build_month(month_key, export) for month_key, export in zip(months, exports)]
+    with ProcessPoolExecutor(max_workers=min(BUILD_WORKERS, len(months))) as executor:
+        return list(executor.map(build_month, months, exports))
 
 def main():
-    plate_mappings = load_plate_mappings()
+    reconciler = PlateReconciler(load_plate_mappings(), PLATE_MAX_DISTANCE, PLATE_MIN_READS)
     
-    for account, password in [
-        (os.getenv('EMAIL1'), os.getenv('EMAIL1_PASSWORD')),
-        (os.getenv('EMAIL2'), os.getenv('EMAIL2_PASSWORD'))
-    ]:
-        if account and password:
-            fetch_email_attachments(account, password)
+    sync_mailboxes(load_accounts())
 
-    monthly_data = {}
+    # Only months fed by new, changed or removed files are parsed again
+    manifest = load_manifest()
+    entries, changed, removed = scan_sources(manifest)
+    store = EventStore()
+    engine = IntervalEngine(store, reconciler, VISIT_MAX_DAYS)
+    stored = store.months()
+    months = {entries[file]['month'] for file in entries}
+    touched = {entries[file]['month'] for file in changed}
+    touched |= {manifest['files'][file]['month'] for file in removed}
+    touched |= months - stored
 
-    for file in [f for f in os.listdir('./csvdata') if f.endswith('.CSV')]:
-        if date_match := re.search(r'(\d{4}-\d{2}-\d{2})', file):
-            month_key = datetime.strptime(date_match.group(1), '%Y-%m-%d').strftime('%Y-%m')
-            
-            df = pd.read_csv(f'./csvdata/{file}', encoding='utf-8')
-            df = df[df['Номерной знак'] != 'Не лицензировано']
-            
-            df = df[['Номерной знак', 'Белый список', 'Время мом. снимка', 'ТС спереди или сзади']].copy()
-            df.insert(0, 'Канал', identify_channel(file))
-            
-            monthly_data[month_key] = pd.concat([monthly_data.get(month_key, pd.DataFrame()), df])
-
-    for month_key, df in monthly_data.items():
-        df['Время мом. снимка'] = pd.to_datetime(df['Время мом. снимка'])
-        df_sorted = df.sort_values(['Номерной знак', 'Время мом. снимка'])
-        
-        base_path = f'./csvbymonth/data_{month_key}.csv'
-        df_export = df_sorted.copy()
-        df_export['Время мом. снимка'] = df_export['Время мом. снимка'].dt.strftime('%Y-%m-%d %H:%M:%S')
-        df_export.to_csv(base_path, index=False, encoding='utf-8-sig')
-        
-        intervals = process_intervals(df_sorted, plate_mappings)
-        intervals.to_csv(f'./csvbymonth/intervals_{month_key}.csv', index=False, encoding='utf-8-sig')
-
-    update_sheets_with_intervals()
+    # A new plate mapping or matching setting changes the visits of every month, but not the parsed data
+    mapping_hash = file_hash(PLATE_MAPPING_FILE) if os.path.exists(PLATE_MAPPING_FILE) else None
+    mapping_hash = f"{mapping_hash}:{PLATE_MAX_DISTANCE}:{PLATE_MIN_READS}:{VISIT_MAX_DAYS}"
+    remap = mapping_hash != manifest.get('plate_mapping')
+
+    try:
+        # Earliest time of an added or removed event, the interval engine replays from there
+        earliest = [store.drop_month(month_key) for month_key in (touched - months) & stored]
+
+        # Parse every new or changed file of the touched months in one parallel pass
+        to_parse = [file for file, entry in entries.items() if entry['month'] in touched
+                    and (file in changed or entry['month'] not in stored)]
+        parsed = read_camera_exports(to_parse)
+
+        # New exports are appended to the event store once
+        for month_key in sorted(touched & months):
+            month_parsed = [parsed.pop(file) for file in to_parse if entries[file]['month'] == month_key]
+            earliest.append(store.replace_files(month_key, set(changed) | set(removed), month_parsed))
+            print(f"Stored month: {month_key}")
+
+        # Only the new events are paired with the entries still open from earlier runs
+        affected = engine.reset() if remap else set()
+        affected |= engine.update(min((ts for ts in earliest if ts is not None), default=None))
+        for month_key, matches in sorted(engine.matches.items()):
+            print(f"{month_key}: matched {len(matches)} misread plates: "
+                  + ", ".join(f"{plate} -> {target}" for plate, target in sorted(matches.items())))
+
+        rebuild = (affected | touched | (months if remap else set())) & months
+    finally:
+        store.close()
+
+    # Months are independent once the store and the visits are up to date
+    for month_key, events, visits, seconds in build_months(rebuild, touched):
+        counts = f"{events} events, {visits} visits" if events is not None else f"{visits} visits"
+        print(f"Rebuilt month: {month_key} ({counts}, {seconds:.1f}s)")
+
+    # Months that failed to publish last time are retried
+    unpublished = update_sheets_with_intervals(rebuild | (set(manifest.get('unpublished', [])) & months))
+    save_manifest({'files': entries, 'plate_mapping': mapping_hash, 'unpublished': sorted(unpublished)})
     print("Processing complete. Results available in csvbymonth folder and Google Sheets.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,197 @@
+"""Persistent store of the camera events read from the exports.
+
+Every parsed export is appended to an SQLite table once, indexed by (month, plate,
+time), so a month or the passages of one plate are read without touching the rest
+of the history. csvconv rebuilds its monthly reports from here.
+
+Ad-hoc lookups from the command line:
+
+    python event_store.py plate 1234AB5 --start 2024-01-01 --end 2024-03-01
+    python event_store.py month 2024-02
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pandas as pd
+
+EVENT_STORE_FILE = 'parking_events.db'
+
+# Table column -> column of the frames used by csvconv
+FRAME_COLUMNS = {
+    'channel': 'Канал',
+    'plate': 'Номерной знак',
+    'whitelist': 'Белый список',
+    'ts': 'Время мом. снимка',
+    'side': 'ТС спереди или сзади',
+    'source': 'Файл',
+}
+CATEGORY_COLUMNS = ['channel', 'plate', 'whitelist', 'side', 'source']
+INSERT_BATCH = 50_000  # Rows per executemany call
+
+def epoch_seconds(timestamp):
+    """Whole seconds since the epoch of a naive timestamp, as stored in the ts column"""
+    return (pd.Timestamp(timestamp) - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+
+class EventStore:
+    """Camera events in SQLite, one row per snapshot.
+
+    Times are stored as whole seconds since the epoch (naive local time, as in the
+    exports). The `months` table keeps the row count of every stored month.
+
+    A `readonly` store opens an existing database for reading only and skips the
+    schema setup, so report workers never wait for the write lock.
+    """
+
+    def __init__(self, path=EVENT_STORE_FILE, readonly=False):
+        self.readonly = readonly
+        if readonly:
+            self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            return
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS events
+                             (month TEXT NOT NULL, plate TEXT, ts INTEGER, channel TEXT,
+                              whitelist TEXT, side TEXT, source TEXT NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS events_month_plate_ts ON events (month, plate, ts)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS events_source ON events (source)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS events_ts ON events (ts)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS months (month TEXT PRIMARY KEY, event_count INTEGER)')
+        self.conn.commit()
+
+    def months(self):
+        """Return the set of stored months"""
+        return {row[0] for row in self.conn.execute('SELECT month FROM months')}
+
+    def replace_files(self, month_key, replaced_files, frames):
+        """Drop the events of changed or removed files from a month and append the
+        freshly parsed exports, in one transaction.
+
+        Returns the earliest time (epoch seconds) of a removed or added event, or None.
+        """
+        earliest = []
+        with self.conn:
+            for file in replaced_files:
+                earliest.append(self.conn.execute('SELECT MIN(ts) FROM events WHERE source = ? AND month = ?',
+                                                  (file, month_key)).fetchone()[0])
+                self.conn.execute('DELETE FROM events WHERE source = ? AND month = ?', (file, month_key))
+            for frame in frames:
+                earliest.append(self._insert(month_key, frame))
+            count = self.conn.execute('SELECT COUNT(*) FROM events WHERE month = ?', (month_key,)).fetchone()[0]
+            self.conn.execute('INSERT OR REPLACE INTO months VALUES (?, ?)', (month_key, count))
+        return min((ts for ts in earliest if ts is not None), default=None)
+
+    def drop_month(self, month_key):
+        """Remove a month. Returns the earliest time of its events, or None."""
+        with self.conn:
+            earliest = self.conn.execute('SELECT MIN(ts) FROM events WHERE month = ?', (month_key,)).fetchone()[0]
+            self.conn.execute('DELETE FROM events WHERE month = ?', (month_key,))
+            self.conn.execute('DELETE FROM months WHERE month = ?', (month_key,))
+        return earliest
+
+    def _insert(self, month_key, frame):
+        if not len(frame):
+            return None
+        # Rows go in in index order, so the events of a plate end up close together on disk
+        frame = frame.sort_values([FRAME_COLUMNS['plate'], FRAME_COLUMNS['ts']], kind='stable')
+        times = frame[FRAME_COLUMNS['ts']].to_numpy('datetime64[s]')
+        seconds = times.astype('int64').astype(object)
+        seconds[np.isnat(times)] = None
+        columns = [[month_key] * len(frame)]
+        for column in ('plate', 'channel', 'whitelist', 'side', 'source'):
+            values = frame[FRAME_COLUMNS[column]].astype(object)
+            columns.append(values.where(values.notna(), None).tolist())
+        columns.insert(2, seconds.tolist())
+        rows = list(zip(*columns))
+        for start in range(0, len(rows), INSERT_BATCH):
+            self.conn.executemany('''INSERT INTO events (month, plate, ts, channel, whitelist, side, source)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?)''', rows[start:start + INSERT_BATCH])
+        valid = times[~np.isnat(times)]
+        return int(valid.min().astype('int64')) if len(valid) else None
+
+    def _frame(self, sql, params):
+        names = ['channel', 'plate', 'whitelist', 'ts', 'side', 'source']
+        rows = self.conn.execute(f"SELECT {', '.join(names)} FROM events {sql}", params).fetchall()
+        df = pd.DataFrame.from_records(rows, columns=names)
+        for column in CATEGORY_COLUMNS:
+            df[column] = df[column].astype('category')
+        df['ts'] = pd.to_datetime(df['ts'], unit='s')
+        return df.rename(columns=FRAME_COLUMNS)
+
+    def plate_counts(self, month_key):
+        """Return a Series with the number of events of every plate in a month"""
+        rows = self.conn.execute('''SELECT plate, COUNT(*) FROM events
+                                    WHERE month = ? AND plate IS NOT NULL GROUP BY plate''',
+                                 (month_key,)).fetchall()
+        return pd.Series(dict(rows), dtype='int64')
+
+    def paired_plates(self, month_key):
+        """Return the set of plates with a CH01 entry followed by a CH02 exit of
+        their own in a month (see plate_matching.paired_plates)"""
+        rows = self.conn.execute('''SELECT plate FROM events
+                                    WHERE month = ? AND plate IS NOT NULL GROUP BY plate
+                                    HAVING MIN(CASE WHEN channel = 'CH01' THEN ts END)
+                                           < MAX(CASE WHEN channel = 'CH02' THEN ts END)''',
+                                 (month_key,)).fetchall()
+        return {row[0] for row in rows}
+
+    def month_events(self, month_key):
+        """Return all events of a YYYY-MM month, by plate and time"""
+        return self._frame('WHERE month = ? ORDER BY plate, ts, source, rowid', (month_key,))
+
+    def plate_events(self, plate, start=None, end=None):
+        """Return the events of one plate with start <= time < end, in time order.
+        Only the months overlapping the range are read."""
+        months = sorted(self.months())
+        if start is not None:
+            start = pd.Timestamp(start)
+            months = [m for m in months if m >= start.strftime('%Y-%m')]
+        if end is not None:
+            end = pd.Timestamp(end)
+            months = [m for m in months if m <= end.strftime('%Y-%m')]
+        if not months:
+            return self._frame('WHERE 0', ())
+        sql = f"WHERE month IN ({', '.join('?' * len(months))}) AND plate = ?"
+        params = [*months, plate]
+        if start is not None:
+            sql += ' AND ts >= ?'
+            params.append(epoch_seconds(start))
+        if end is not None:
+            sql += ' AND ts < ?'
+            params.append(epoch_seconds(end))
+        return self._frame(sql + ' ORDER BY ts', params)
+
+    def close(self):
+        self.conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Look up stored camera events")
+    commands = parser.add_subparsers(dest='command', required=True)
+    plate = commands.add_parser('plate', help="events of one plate")
+    plate.add_argument('plate')
+    plate.add_argument('--start', help="first time, e.g. 2024-01-01")
+    plate.add_argument('--end', help="time after the last one, e.g. 2024-02-01")
+    month = commands.add_parser('month', help="events of one month")
+    month.add_argument('month', help="YYYY-MM")
+    parser.add_argument('--db', default=EVENT_STORE_FILE, help=f"store file (default: {EVENT_STORE_FILE})")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        parser.error(f"no event store at {args.db}, run from the csvconv.py directory or pass --db")
+
+    # Read-only: never creates a store in the wrong directory or waits for a running csvconv
+    store = EventStore(args.db, readonly=True)
+    try:
+        if args.command == 'plate':
+            df = store.plate_events(args.plate, args.start, args.end)
+        else:
+            df = store.month_events(args.month)
+    finally:
+        store.close()
+    df.to_csv(sys.stdout, index=False)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""In-memory stand-in for the Google Sheets v4 service.
+
+Implements the calls made by csvconv (spreadsheets().get/batchUpdate and
+values().clear/update/batchClear/batchUpdate) so the publishing step can be run
+offline. csvconv uses it when SHEETS_DRY_RUN is set in the environment.
+"""
+import re
+
+
+class _Request:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self):
+        return self._result
+
+
+class FakeSheetsService:
+    """Keep sheet contents in memory and record every API call made against it"""
+
+    def __init__(self, titles=(), verbose=False):
+        self.sheets = {title: [] for title in titles}
+        self.calls = []
+        self.verbose = verbose
+
+    def spreadsheets(self):
+        return _Spreadsheets(self)
+
+    def _record(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        if self.verbose:
+            print(f"[sheets dry run] {method}")
+
+    @staticmethod
+    def _sheet_name(range_name):
+        return re.sub(r"^'(.*)'$", r'\1', range_name.split('!')[0])
+
+
+class _Spreadsheets:
+    def __init__(self, service):
+        self._service = service
+
+    def get(self, spreadsheetId, **kwargs):
+        self._service._record('spreadsheets.get', spreadsheetId=spreadsheetId)
+        return _Request({'sheets': [{'properties': {'title': title}} for title in self._service.sheets]})
+
+    def batchUpdate(self, spreadsheetId, body):
+        self._service._record('spreadsheets.batchUpdate', spreadsheetId=spreadsheetId, body=body)
+        for request in body.get('requests', []):
+            if 'addSheet' in request:
+                title = request['addSheet']['properties']['title']
+                if title in self._service.sheets:
+                    raise ValueError(f"A sheet with the name \"{title}\" already exists")
+                self._service.sheets[title] = []
+        return _Request({'replies': [{} for _ in body.get('requests', [])]})
+
+    def values(self):
+        return _Values(self._service)
+
+
+class _Values:
+    def __init__(self, service):
+        self._service = service
+
+    def _sheet(self, range_name):
+        name = self._service._sheet_name(range_name)
+        if name not in self._service.sheets:
+            raise ValueError(f"Unable to parse range: {range_name}")
+        return name
+
+    def clear(self, spreadsheetId, range):
+        self._service._record('values.clear', spreadsheetId=spreadsheetId, range=range)
+        self._service.sheets[self._sheet(range)] = []
+        return _Request({'clearedRange': range})
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        self._service._record('values.update', spreadsheetId=spreadsheetId, range=range, body=body)
+        self._service.sheets[self._sheet(range)] = body['values']
+        return _Request({'updatedRange': range})
+
+    def batchClear(self, spreadsheetId, body):
+        self._service._record('values.batchClear', spreadsheetId=spreadsheetId, body=body)
+        for range_name in body['ranges']:
+            self._service.sheets[self._sheet(range_name)] = []
+        return _Request({'clearedRanges': body['ranges']})
+
+    def batchUpdate(self, spreadsheetId, body):
+        self._service._record('values.batchUpdate', spreadsheetId=spreadsheetId, body=body)
+        for data in body['data']:
+            self._service.sheets[self._sheet(data['range'])] = data['values']
+        return _Request({'totalUpdatedSheets': len(body['data'])})
@@ -0,0 +1,246 @@
+"""Streaming computation of parking visits from the event store.
+
+The engine reads the stored camera events in time order and pairs every CH01
+entry with the next CH02 exit of the same plate, like csvconv.process_intervals,
+but keeps the entries still waiting for an exit between runs. A run only reads the
+events that arrived since the last one, and a car that enters on the 31st and
+leaves on the 1st is counted. Visits belong to the month of their entry.
+
+Everything lives in the event store's database, next to the events:
+    intervals     closed visits (plate, entry month, entry, exit, minutes)
+    month_totals  visits and minutes per month and plate, updated by delta
+    open_visits   entries without an exit yet
+    abandoned     entries given up after max_visit_days without an exit
+    engine_state  time of the last event consumed (watermark) and the known plates
+                  every month was resolved against
+
+Events that arrive with a time at or before the watermark (a late export, a changed
+or removed file) rewind the engine to that time and replay the events from there.
+New reads can also make a plate of their month known, which changes how the
+month's earlier reads resolve, so a month whose known plates change is replayed
+from its first event.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+class IntervalEngine:
+    """Incrementally maintained visits of an EventStore.
+
+    Plates are resolved with `reconciler` against the known plates of their month
+    (see PlateReconciler.known_plates), and the results match a full rebuild. Entries without an exit for more than
+    `max_visit_days` are abandoned, so a missed exit does not pair with one weeks later.
+    With a read-only store the tables are expected to exist and only the month_*
+    readers can be used.
+    """
+
+    def __init__(self, store, reconciler, max_visit_days=31):
+        self.store = store
+        self.conn = store.conn
+        self.reconciler = reconciler
+        self.max_visit_seconds = int(max_visit_days * 86400)
+        self.matches = {}  # Month -> {plate: known plate} merged by the reconciler in the last update
+        if store.readonly:
+            return
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS intervals
+                             (plate TEXT NOT NULL, month TEXT NOT NULL, entry_ts INTEGER NOT NULL,
+                              exit_ts INTEGER NOT NULL, minutes INTEGER NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS intervals_month_plate ON intervals (month, plate, entry_ts)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS intervals_exit ON intervals (exit_ts)')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS month_totals
+                             (month TEXT NOT NULL, plate TEXT NOT NULL, visits INTEGER NOT NULL,
+                              minutes INTEGER NOT NULL, PRIMARY KEY (month, plate))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS open_visits
+                             (plate TEXT PRIMARY KEY, month TEXT NOT NULL, entry_ts INTEGER NOT NULL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS abandoned
+                             (plate TEXT NOT NULL, month TEXT NOT NULL, entry_ts INTEGER NOT NULL,
+                              abandoned_ts INTEGER NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS abandoned_ts ON abandoned (abandoned_ts)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS engine_state (key TEXT PRIMARY KEY, value)')
+        self.conn.commit()
+
+    def _get_state(self, key):
+        row = self.conn.execute('SELECT value FROM engine_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO engine_state VALUES (?, ?)', (key, value))
+
+    @property
+    def watermark(self):
+        """Time (epoch seconds) of the last consumed event, None before the first run"""
+        return self._get_state('watermark')
+
+    def reset(self):
+        """Forget all visits, the next update() replays every stored event.
+        Returns the months that had visits."""
+        months = {row[0] for row in self.conn.execute('SELECT DISTINCT month FROM month_totals')}
+        with self.conn:
+            for table in ('intervals', 'month_totals', 'open_visits', 'abandoned', 'engine_state'):
+                self.conn.execute(f'DELETE FROM {table}')
+        return months
+
+    def _add_totals(self, closed, sign):
+        """Add (sign=1) or subtract (sign=-1) closed visits from month_totals"""
+        if not len(closed):
+            return
+        totals = closed.groupby(['month', 'plate'], sort=False)['minutes'].agg(['size', 'sum'])
+        self.conn.executemany('''INSERT INTO month_totals VALUES (?, ?, ?, ?)
+                                 ON CONFLICT (month, plate) DO UPDATE
+                                 SET visits = visits + excluded.visits, minutes = minutes + excluded.minutes''',
+                              [(month, plate, sign * int(visits), sign * int(minutes))
+                               for (month, plate), (visits, minutes) in totals.iterrows()])
+        if sign < 0:
+            self.conn.execute('DELETE FROM month_totals WHERE visits <= 0')
+
+    def _rewind(self, since):
+        """Undo every visit that closed or was abandoned at or after `since` and
+        restore the entries that were open at that time. Returns the months whose
+        visits changed."""
+        closed = pd.DataFrame(self.conn.execute('''SELECT plate, month, entry_ts, exit_ts, minutes
+                                                   FROM intervals WHERE exit_ts >= ?''', (since,)).fetchall(),
+                              columns=['plate', 'month', 'entry_ts', 'exit_ts', 'minutes'])
+        self.conn.execute('DELETE FROM intervals WHERE exit_ts >= ?', (since,))
+        self._add_totals(closed, -1)
+        self.conn.execute('DELETE FROM open_visits WHERE entry_ts >= ?', (since,))
+        reopened = closed.loc[closed['entry_ts'] < since, ['plate', 'month', 'entry_ts']].itertuples(index=False, name=None)
+        self.conn.executemany('INSERT OR REPLACE INTO open_visits VALUES (?, ?, ?)', reopened)
+        abandoned = self.conn.execute('''SELECT plate, month, entry_ts FROM abandoned
+                                         WHERE abandoned_ts >= ? AND entry_ts < ?''', (since, since)).fetchall()
+        self.conn.execute('DELETE FROM abandoned WHERE abandoned_ts >= ?', (since,))
+        self.conn.executemany('INSERT OR REPLACE INTO open_visits VALUES (?, ?, ?)', abandoned)
+        return set(closed['month'])
+
+    def _known_plates(self, since):
+        """Recompute the known plates of every month with events at or after `since`
+        (all months if None) and store them in engine_state.
+
+        Returns the reads of those months, {month: (counts, paired)}, and the time of the
+        first event of the earliest month whose known plates changed, or None.
+        """
+        if since is None:
+            months = self.store.months()
+        else:
+            months = {row[0] for row in self.conn.execute('SELECT DISTINCT month FROM events WHERE ts >= ?', (since,))}
+            since_month = pd.Timestamp(since, unit='s').strftime('%Y-%m')
+            months |= {month for month in self.store.months() if month >= since_month}
+        stored = {key[len('known:'):] for key, in self.conn.execute("SELECT key FROM engine_state WHERE key LIKE 'known:%'")}
+        for month_key in stored - self.store.months():
+            self.conn.execute('DELETE FROM engine_state WHERE key = ?', (f'known:{month_key}',))
+
+        reads = {}
+        restart = []
+        for month_key in sorted(months):
+            reads[month_key] = counts, paired = self.store.plate_counts(month_key), self.store.paired_plates(month_key)
+            # Mapping targets are known in every month, a new mapping resets the engine anyway
+            known = json.dumps(sorted(item for item in self.reconciler.known_plates(counts, paired).items()
+                                      if item[0] not in self.reconciler.targets))
+            previous = self._get_state(f'known:{month_key}')
+            if known != previous:
+                self._set_state(f'known:{month_key}', known)
+                if previous is not None:
+                    restart.append(self.conn.execute('SELECT MIN(ts) FROM events WHERE month = ?',
+                                                     (month_key,)).fetchone()[0])
+        return reads, min((ts for ts in restart if ts is not None), default=None)
+
+    def _read_events(self, since, reads):
+        """Events at or after `since` (all if None) in time order, with resolved plates.
+        Events of the same second keep the order of their files, whatever order those arrived in.
+        `reads` are the month reads from _known_plates, the other months are read here."""
+        sql = '''SELECT month, plate, ts, channel = 'CH01' FROM events
+                 WHERE plate IS NOT NULL AND ts IS NOT NULL AND channel IN ('CH01', 'CH02')'''
+        params = ()
+        if since is not None:
+            sql += ' AND ts >= ?'
+            params = (since,)
+        events = pd.DataFrame(self.conn.execute(sql + ' ORDER BY ts, source, rowid', params).fetchall(),
+                              columns=['month', 'plate', 'ts', 'entry'])
+        self.matches = {}
+        for month_key, group in events.groupby('month', sort=True):
+            if month_key not in reads:
+                reads[month_key] = self.store.plate_counts(month_key), self.store.paired_plates(month_key)
+            counts, paired = reads[month_key]
+            events.loc[group.index, 'plate'] = self.reconciler.resolve(group['plate'], counts=counts, paired=paired)
+            if self.reconciler.matches:
+                self.matches[month_key] = dict(self.reconciler.matches)
+        return events
+
+    def update(self, since=None):
+        """Consume the events that arrived since the last update.
+
+        `since` is the earliest time of an event added or removed since then, as
+        returned by EventStore.replace_files and drop_month; None if only events
+        newer than the watermark were added, or none at all. Returns the months
+        whose visits changed.
+        """
+        watermark = self.watermark
+        affected = set()
+        with self.conn:
+            if watermark is not None:
+                if since is None:
+                    return affected
+                reads, restart = self._known_plates(since)
+                if restart is not None and restart < since:
+                    since = restart
+                if since <= watermark:
+                    affected |= self._rewind(since)
+            else:
+                since = None
+                reads, _ = self._known_plates(None)
+
+            events = self._read_events(since, reads)
+            if not len(events):
+                if since is not None:
+                    self._set_state('watermark', since - 1)
+                return affected
+
+            plates = set(events['plate'])
+            open_visits = {plate: (entry_ts, month)
+                           for plate, month, entry_ts in self.conn.execute('SELECT plate, month, entry_ts FROM open_visits')
+                           if plate in plates}
+            closed = []
+            abandoned = []
+            max_visit = self.max_visit_seconds
+            for month_key, plate, ts, entry in events.itertuples(index=False, name=None):
+                visit = open_visits.get(plate)
+                if visit is not None and ts - visit[0] > max_visit:
+                    abandoned.append((plate, visit[1], visit[0], ts))
+                    visit = None
+                    del open_visits[plate]
+                if entry:
+                    if visit is None:
+                        open_visits[plate] = (ts, month_key)
+                elif visit is not None:
+                    del open_visits[plate]
+                    closed.append((plate, visit[1], visit[0], ts, (ts - visit[0]) // 60))
+
+            closed = pd.DataFrame(closed, columns=['plate', 'month', 'entry_ts', 'exit_ts', 'minutes'])
+            self.conn.executemany('INSERT INTO intervals VALUES (?, ?, ?, ?, ?)',
+                                  closed.itertuples(index=False, name=None))
+            self._add_totals(closed, 1)
+            self.conn.executemany('INSERT INTO abandoned VALUES (?, ?, ?, ?)', abandoned)
+            self.conn.executemany('DELETE FROM open_visits WHERE plate = ?', ((plate,) for plate in plates))
+            self.conn.executemany('INSERT INTO open_visits VALUES (?, ?, ?)',
+                                  ((plate, month, entry_ts) for plate, (entry_ts, month) in open_visits.items()))
+            self._set_state('watermark', int(events['ts'].iloc[-1]))
+            affected |= set(closed['month'])
+        return affected
+
+    def month_intervals(self, month_key):
+        """Closed visits that entered in a month: plate, entry and exit time, minutes,
+        ordered by plate and entry"""
+        df = pd.DataFrame(self.conn.execute('''SELECT plate, entry_ts, exit_ts, minutes FROM intervals
+                                               WHERE month = ? ORDER BY plate, entry_ts''',
+                                            (month_key,)).fetchall(),
+                          columns=['plate', 'entry', 'exit', 'minutes'])
+        df['entry'] = pd.to_datetime(df['entry'], unit='s')
+        df['exit'] = pd.to_datetime(df['exit'], unit='s')
+        df['minutes'] = df['minutes'].astype(np.int64)
+        return df
+
+    def month_totals(self, month_key):
+        """Number of visits and minutes per plate for a month, ordered by plate"""
+        return pd.DataFrame(self.conn.execute('''SELECT plate, visits, minutes FROM month_totals
+                                                 WHERE month = ? ORDER BY plate''', (month_key,)).fetchall(),
+                            columns=['plate', 'visits', 'minutes'])
@@ -0,0 +1,182 @@
+"""Approximate matching of licence plates read by the cameras.
+
+OCR misreads (0 read as O, a dropped character, Cyrillic letters instead of their
+Latin lookalikes) turn one vehicle into several plates, so its entries and exits
+no longer pair up. csvconv resolves every plate with a PlateReconciler before
+computing the intervals.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+# Characters that OCR confuses, folded onto one of them. Cyrillic letters become
+# their Latin lookalikes as in the NVR processor; O/Q and I become digits.
+LOOKALIKES = str.maketrans({
+    'А': 'A', 'В': 'B', 'Е': 'E', 'К': 'K', 'М': 'M', 'Н': 'H',
+    'О': '0', 'Р': 'P', 'С': 'C', 'Т': 'T', 'У': 'Y', 'Х': 'X',
+    'І': '1', 'O': '0', 'Q': '0', 'I': '1'
+})
+SEPARATORS_RE = re.compile(r'[\s\-_.]')
+FUZZY_MIN_LENGTH = 6  # Shorter reads are too ambiguous to match approximately
+
+def normalize_plate(plate):
+    """Upper-case the plate, drop separators and fold lookalike characters"""
+    return SEPARATORS_RE.sub('', str(plate).upper()).translate(LOOKALIKES)
+
+def edit_distance(a, b):
+    """Levenshtein distance between two strings"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def deletions(key, depth):
+    """All strings made by deleting up to `depth` characters from key, key included"""
+    variants = {key}
+    frontier = {key}
+    for _ in range(depth):
+        frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+        variants |= frontier
+    return variants
+
+class DeletionIndex:
+    """Index of strings for finding all keys within an edit distance (symmetric delete).
+
+    Two strings within d edits share a string obtained by deleting at most d
+    characters from each, so every key is stored under its deletion variants and a
+    query only compares against the keys sharing one of its own variants. Plates are
+    short, so a handful of dictionary lookups replaces a scan of all known plates.
+    """
+
+    def __init__(self, keys=(), max_distance=1):
+        self.max_distance = max_distance
+        self._variants = {}
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        for variant in deletions(key, self.max_distance):
+            self._variants.setdefault(variant, set()).add(key)
+
+    def search(self, key, radius=None):
+        """Return (distance, key) for every key within `radius` edits of `key`"""
+        radius = self.max_distance if radius is None else min(radius, self.max_distance)
+        candidates = set()
+        for variant in deletions(key, radius):
+            candidates |= self._variants.get(variant, set())
+        found = []
+        for candidate in candidates:
+            if abs(len(candidate) - len(key)) <= radius:
+                distance = edit_distance(key, candidate)
+                if distance <= radius:
+                    found.append((distance, candidate))
+        return found
+
+def paired_plates(plates, channels, times):
+    """Return the set of plates with a CH01 entry followed by a CH02 exit among
+    their own reads, i.e. a visit that pairs without any matching"""
+    channels = np.asarray(channels)
+    times = pd.Series(np.asarray(times))
+    df = pd.DataFrame({'plate': np.asarray(plates, dtype=object),
+                       'entry': times.where(channels == 'CH01'),
+                       'exit': times.where(channels == 'CH02')})
+    bounds = df.groupby('plate', sort=False).agg(entry=('entry', 'min'), exit=('exit', 'max'))
+    return set(bounds.index[bounds['entry'] < bounds['exit']])
+
+class PlateReconciler:
+    """Resolve plates as read to the plates of known vehicles.
+
+    A plate resolves, in this order, to
+      1. its target in plate_mapping.txt,
+      2. the known plate with the same normalized form (see normalize_plate),
+      3. the closest known plate within `max_distance` edits of its normalized form,
+         if the plate was read fewer than `min_reads` times, its reads do not pair
+         on their own and the closest match is unique.
+    Known plates are the mapping targets, the plates read at least `min_reads`
+    times in the data being resolved and the plates with an entry followed by an
+    exit of their own (a one-off visitor); anything else is left as it is.
+
+    The index of mapping targets is built once, and lookups against it are memoized
+    for all the data resolved with this reconciler. The plates read often enough
+    form a small per-call index.
+    """
+
+    def __init__(self, mappings, max_distance=1, min_reads=3):
+        self.mappings = mappings
+        self.max_distance = max_distance
+        self.min_reads = min_reads
+        self.targets = {}
+        for target in sorted(set(mappings.values())):
+            self.targets.setdefault(normalize_plate(target), target)
+        self._index = DeletionIndex(self.targets, max_distance)
+        self._nearest = {}
+        self.matches = {}  # Plate -> known plate, for the plates merged by the last resolve()
+
+    def nearest_targets(self, key):
+        """(distance, normalized target) of the mapping targets within max_distance of key"""
+        found = self._nearest.get(key)
+        if found is None:
+            found = self._nearest[key] = self._index.search(key, self.max_distance)
+        return found
+
+    def known_plates(self, counts, paired=()):
+        """Return {normalized plate: plate} of the known plates: the mapping targets,
+        then the plates read at least min_reads times or in `paired`. The most read
+        plate wins within a normalized form."""
+        known = dict(self.targets)
+        real = counts[(counts >= self.min_reads) | counts.index.isin(list(paired))]
+        for plate, _ in sorted(real.items(), key=lambda item: (-item[1], item[0])):
+            plate = self.mappings.get(plate, plate)
+            known.setdefault(normalize_plate(plate), plate)
+        return known
+
+    def resolve(self, plates, counts=None, paired=()):
+        """Return a Series with the resolved plate of every read, index unchanged.
+
+        `counts` (plate -> number of reads) decides which plates are read often enough
+        to be known. By default the reads in `plates` are counted; pass the counts of
+        the whole month when resolving only part of it. `paired` are the plates whose
+        reads pair on their own (see paired_plates); they are known and never merged.
+        """
+        codes, uniques = pd.factorize(plates.astype(object))
+        if counts is None:
+            counts = pd.Series(np.bincount(codes[codes >= 0], minlength=len(uniques)), index=uniques)
+        reads = counts.reindex(uniques, fill_value=0).to_numpy()
+        paired = set(paired)
+
+        known = self.known_plates(counts, paired)
+        local = DeletionIndex((key for key in known if key not in self.targets), self.max_distance)
+
+        resolved = np.empty(len(uniques), dtype=object)
+        self.matches = {}
+        for code, plate in enumerate(uniques):
+            real = reads[code] >= self.min_reads or plate in paired
+            resolved[code] = target = self._resolve_one(plate, real, known, local)
+            if target != plate and plate not in self.mappings:
+                self.matches[plate] = target
+
+        if not len(uniques):
+            return plates.astype(object)
+        result = pd.Series(resolved[np.maximum(codes, 0)], index=plates.index, dtype=object)
+        return result.where(codes >= 0, None)
+
+    def _resolve_one(self, plate, real, known, local):
+        if plate in self.mappings:
+            return self.mappings[plate]
+        key = normalize_plate(plate)
+        if key in known:
+            return known[key]
+        if real or self.max_distance <= 0 or len(key) < FUZZY_MIN_LENGTH:
+            return plate
+        candidates = self.nearest_targets(key) + local.search(key, self.max_distance)
+        if not candidates:
+            return plate
+        best = min(distance for distance, _ in candidates)
+        closest = {known[match] for distance, match in candidates if distance == best}
+        return closest.pop() if len(closest) == 1 else plate
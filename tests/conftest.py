@@ -0,0 +1,39 @@
+"""The scripts are imported from their folders, like in the benchmarks. csvconv
+creates its folders in the current directory on import, so it is imported from a
+temporary directory."""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('telegram_parking_bot', 'csv_file_processor', 'telegram_mail_bot'):
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+@pytest.fixture(scope='session')
+def csvconv(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('import'))
+    try:
+        import csvconv
+    finally:
+        os.chdir(cwd)
+    return csvconv
+
+@pytest.fixture
+def export_frame():
+    """Factory of event frames like the parsed camera exports, from (plate, channel,
+    time) rows, all from one source file"""
+    def make(rows, source='export.CSV'):
+        return pd.DataFrame({
+            'Канал': [channel for _, channel, _ in rows],
+            'Номерной знак': [plate for plate, _, _ in rows],
+            'Белый список': 'Нет',
+            'Время мом. снимка': pd.to_datetime([time for _, _, time in rows]),
+            'ТС спереди или сзади': 'Спереди',
+            'Файл': source,
+        })
+    return make
@@ -0,0 +1,23 @@
+import sqlite3
+
+import pytest
+
+from event_store import EventStore
+from interval_engine import IntervalEngine
+from plate_matching import PlateReconciler
+
+def test_readonly_store_reads_without_writing(tmp_path, export_frame):
+    path = str(tmp_path / 'events.db')
+    store = EventStore(path)
+    df = export_frame([('1234AB-1', 'CH01', '2024-01-01 08:00'), ('1234AB-1', 'CH02', '2024-01-01 09:30')])
+    store.replace_files('2024-01', [], [df])
+    IntervalEngine(store, PlateReconciler({})).update()
+    store.close()
+
+    reader = EventStore(path, readonly=True)
+    engine = IntervalEngine(reader, None)
+    assert reader.months() == {'2024-01'}
+    assert engine.month_totals('2024-01').values.tolist() == [['1234AB-1', 1, 90]]
+    with pytest.raises(sqlite3.OperationalError):
+        reader.drop_month('2024-01')
+    reader.close()
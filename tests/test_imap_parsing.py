@@ -0,0 +1,90 @@
+"""The BODYSTRUCTURE and FETCH parsers of the mail bot and of csvconv, on responses
+shaped like imaplib returns them"""
+import pytest
+
+import bot
+
+# multipart/mixed with a multipart/alternative body, a base64 JPEG named with RFC 2231,
+# and a nested multipart/mixed with an RFC 2047 named PNG and a quoted-printable CSV
+ALTERNATIVE = (b'(("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "7BIT" 12 1 NIL NIL NIL)'
+               b'("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 40 1 NIL NIL NIL)'
+               b' "ALTERNATIVE" ("BOUNDARY" "alt") NIL NIL)')
+JPEG = (b'("IMAGE" "JPEG" ("NAME" "report.jpg") "<f1>" NIL "BASE64" 8 NIL'
+        b' ("ATTACHMENT" ("FILENAME*" "utf-8\'\'%D0%BE%D1%82%D1%87%D1%91%D1%82%201.jpg")) NIL)')
+PNG = (b'("IMAGE" "PNG" ("NAME" "=?UTF-8?B?0YTQvtGC0L4ucG5n?=") NIL NIL "BASE64" 8 NIL'
+       b' ("INLINE" ("FILENAME" "=?UTF-8?B?0YTQvtGC0L4ucG5n?=")) NIL)')
+CSV = (b'("TEXT" "CSV" ("CHARSET" "UTF-8" "NAME" "export.CSV") NIL NIL "QUOTED-PRINTABLE" 20 1 NIL'
+       b' ("ATTACHMENT" ("FILENAME" "export.CSV")) NIL)')
+QUOTED = b'("IMAGE" "GIF" NIL NIL NIL "BASE64" 8 NIL ("ATTACHMENT" ("FILENAME" "a \\"b\\".gif")) NIL)'
+MIXED = (b'(' + ALTERNATIVE + JPEG + b'(' + PNG + CSV + b' "MIXED" ("BOUNDARY" "inner") NIL NIL)'
+         + QUOTED + b' "MIXED" ("BOUNDARY" "outer") NIL NIL)')
+
+# A file name sent as a literal ends one tuple, the rest of the response follows
+LITERAL_NAME = [(b'2 (UID 6 BODYSTRUCTURE ("IMAGE" "JPEG" NIL NIL NIL "BASE64" 8 NIL'
+                 b' ("ATTACHMENT" ("FILENAME" {9}', b'lit 1.jpg'),
+                b')) NIL))']
+
+JPEG_BYTES = b'\xff\xd8\xff\xe0 jpeg'
+CSV_TEXT = b'plate=1234AB-7\r\n'
+BODY_PARTS = [(b'5 (UID 5 BODY[2] {16}', b'/9j/4CBqcGVn\r\n'),
+              (b' BODY[3.2] {20}', b'plate=3D1234AB=\r\n-7\r\n'),
+              b')']
+
+class FakeClient:
+    def __init__(self, data):
+        self.data = data
+        self.commands = []
+
+    def uid(self, command, uids, items):
+        self.commands.append((command, uids, items))
+        return 'OK', self.data
+
+class FakeMailbox:
+    def __init__(self, data):
+        self.client = FakeClient(data)
+
+def test_bot_body_structures():
+    data = [b'1 (UID 5 BODYSTRUCTURE ' + MIXED + b')'] + LITERAL_NAME
+    structures = bot.fetch_body_structures(FakeMailbox(data), ['5', '6'])
+    assert structures == {
+        '5': [bot.BodyPart('1.1', None, '7BIT'),
+              bot.BodyPart('1.2', None, 'QUOTED-PRINTABLE'),
+              bot.BodyPart('2', 'отчёт 1.jpg', 'BASE64'),
+              bot.BodyPart('3.1', 'фото.png', 'BASE64'),
+              bot.BodyPart('3.2', 'export.CSV', 'QUOTED-PRINTABLE'),
+              bot.BodyPart('4', 'a "b".gif', 'BASE64')],
+        '6': [bot.BodyPart('1', 'lit 1.jpg', 'BASE64')],
+    }
+
+def test_bot_fetches_and_decodes_parts():
+    mailbox = FakeMailbox(BODY_PARTS)
+    parts = [bot.BodyPart('2', 'отчёт 1.jpg', 'BASE64'), bot.BodyPart('3.2', 'export.CSV', 'QUOTED-PRINTABLE')]
+    assert bot.fetch_body_parts(mailbox, '5', parts) == [('отчёт 1.jpg', JPEG_BYTES), ('export.CSV', CSV_TEXT)]
+    assert mailbox.client.commands == [('FETCH', '5', '(BODY.PEEK[2] BODY.PEEK[3.2])')]
+
+def test_csvconv_attachment_parts(csvconv):
+    header = b'Message-ID: <m5@example.com>\r\nSubject: export\r\n\r\n'
+    data = [(b'1 (UID 5 BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT DATE)] {%d}' % len(header), header),
+            b' BODYSTRUCTURE ' + MIXED + b')'] + LITERAL_NAME
+    messages = csvconv.parse_fetch_response(data)
+    assert [message[b'UID'] for message in messages] == [b'5', b'6']
+    assert messages[0][b'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT DATE)]'] == header
+    assert csvconv.attachment_parts(messages[0][b'BODYSTRUCTURE']) == [
+        ('2', 'отчёт 1.jpg', 'BASE64'),
+        ('3.1', 'фото.png', 'BASE64'),
+        ('3.2', 'export.CSV', 'QUOTED-PRINTABLE'),
+        ('4', 'a "b".gif', 'BASE64'),
+    ]
+    assert csvconv.attachment_parts(messages[1][b'BODYSTRUCTURE']) == [('1', 'lit 1.jpg', 'BASE64')]
+
+def test_csvconv_fetches_and_decodes_parts(csvconv):
+    client = FakeClient(BODY_PARTS)
+    parts = [('2', 'отчёт 1.jpg', 'BASE64'), ('3.2', 'export.CSV', 'QUOTED-PRINTABLE')]
+    assert list(csvconv.fetch_parts(client, '5', parts)) == [('отчёт 1.jpg', JPEG_BYTES), ('export.CSV', CSV_TEXT)]
+
+@pytest.mark.parametrize('structure', [JPEG, PNG])
+def test_both_parsers_agree_on_single_parts(csvconv, structure):
+    data = [b'1 (UID 7 BODYSTRUCTURE ' + structure + b')']
+    from_bot = bot.fetch_body_structures(FakeMailbox(data), ['7'])['7']
+    from_csvconv = csvconv.attachment_parts(csvconv.parse_fetch_response(data)[0][b'BODYSTRUCTURE'])
+    assert [tuple(part) for part in from_bot] == from_csvconv
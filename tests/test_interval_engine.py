@@ -0,0 +1,57 @@
+import pandas as pd
+
+from event_store import EventStore
+from interval_engine import IntervalEngine
+from plate_matching import PlateReconciler
+
+REGULAR = '1234AB-1'
+MISREAD = '1234AB-7'
+
+# The regular's exit on the 1st is misread. The plate is only known from the 3rd
+# read on, and only then does the misread fold into it and close the first visit.
+DAYS = [
+    [(REGULAR, 'CH01', '2024-01-01 08:00'), (MISREAD, 'CH02', '2024-01-01 09:00')],
+    [(REGULAR, 'CH01', '2024-01-02 08:00'), (REGULAR, 'CH02', '2024-01-02 10:00')],
+    [(REGULAR, 'CH01', '2024-01-03 08:00'), (REGULAR, 'CH02', '2024-01-03 08:30')],
+    [(REGULAR, 'CH01', '2024-01-31 22:00')],
+    [(REGULAR, 'CH02', '2024-02-01 01:00'), (MISREAD, 'CH01', '2024-02-01 09:00')],
+]
+
+def load(store, engine, days, export_frame):
+    earliest = []
+    for index, rows in days:
+        month_key = rows[0][2][:7]
+        earliest.append(store.replace_files(month_key, [], [export_frame(rows, f'day{index}.CSV')]))
+    engine.update(min(earliest))
+
+def visits(engine):
+    return {month_key: engine.month_intervals(month_key).values.tolist() for month_key in ('2024-01', '2024-02')}
+
+def test_incremental_matches_full_rebuild_with_fuzzy_matching(tmp_path, export_frame):
+    days = list(enumerate(DAYS))
+    full_store = EventStore(str(tmp_path / 'full.db'))
+    full = IntervalEngine(full_store, PlateReconciler({}, max_distance=1, min_reads=3))
+    load(full_store, full, days, export_frame)
+
+    store = EventStore(str(tmp_path / 'incremental.db'))
+    engine = IntervalEngine(store, PlateReconciler({}, max_distance=1, min_reads=3))
+    for day in days:
+        load(store, engine, [day], export_frame)
+
+    assert visits(full)['2024-01'][0][:2] == [REGULAR, pd.Timestamp('2024-01-01 08:00')]
+    assert visits(engine) == visits(full)
+    for month_key in ('2024-01', '2024-02'):
+        assert engine.month_totals(month_key).values.tolist() == full.month_totals(month_key).values.tolist()
+    full_store.close()
+    store.close()
+
+def test_removed_reads_replay_the_month(tmp_path, export_frame):
+    store = EventStore(str(tmp_path / 'events.db'))
+    engine = IntervalEngine(store, PlateReconciler({}, max_distance=1, min_reads=3))
+    load(store, engine, list(enumerate(DAYS[:3])), export_frame)
+    assert engine.month_totals('2024-01').values.tolist() == [[REGULAR, 3, 210]]
+
+    # With one read left the regular is no longer known and the misread exit stays apart
+    engine.update(store.replace_files('2024-01', ['day1.CSV', 'day2.CSV'], []))
+    assert engine.month_totals('2024-01').values.tolist() == []
+    store.close()
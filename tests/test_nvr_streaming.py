@@ -0,0 +1,29 @@
+import nvr_export_list_processor as nvr
+
+# Duplicates across chunks, empty first-column values, a column that is int in the
+# first chunks and float in a later one, and a DD-MM-YY HH:MM datetime column
+ROWS = [
+    ('А123ВС (гость)', '7', '05-01-24 08:15', 'x'),
+    ('', '8', '05-01-24 09:00', 'y'),
+    ('K777MM', '9', '06-01-24 10:30', ''),
+    ('А123ВС (гость)', '10', '07-01-24 11:45', 'z'),
+    ('P-555-OK', '11', '', 'w'),
+    ('', '12', '08-01-24 12:00', 'v'),
+    ('K777MM', '13.5', '09-01-24 13:15', 'u'),
+    ('Т001ТТ', '', '10-01-24 14:30', 't'),
+    ('P-555-OK', '15', '11-01-24 15:45', 's'),
+]
+
+def write_export(path):
+    lines = ['Номер,Канал,Время,Примечание'] + [','.join(f'"{value}"' for value in row) for row in ROWS]
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8-sig')
+
+def test_streaming_output_matches_in_memory(tmp_path, capsys):
+    path = tmp_path / 'export.csv'
+    write_export(path)
+
+    output = nvr.process_csv(str(path), additional_df=None)
+    in_memory = open(output, 'rb').read()
+    streamed = nvr.process_csv_streaming(str(path), chunksize=2, additional_df=None)
+    assert streamed == output
+    assert open(streamed, 'rb').read() == in_memory
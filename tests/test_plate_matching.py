@@ -0,0 +1,43 @@
+from event_store import EventStore
+from interval_engine import IntervalEngine
+from plate_matching import PlateReconciler, paired_plates
+
+REGULAR = '1234AB-1'
+VISITOR = '1234AB-7'  # One character away from the regular, a different car
+
+def regular_visits(day):
+    return [(REGULAR, 'CH01', f'2024-01-{day:02d} 08:00'), (REGULAR, 'CH02', f'2024-01-{day:02d} 09:00')]
+
+def totals(report):
+    return dict(zip(report['Номерной знак'], zip(report['Количество проездов'], report['Суммарное время (мин)'])))
+
+def test_paired_plates(export_frame):
+    df = export_frame([('A', 'CH01', '2024-01-01 08:00'), ('A', 'CH02', '2024-01-01 09:00'),
+                 ('B', 'CH02', '2024-01-01 08:00'), ('B', 'CH01', '2024-01-01 09:00'),
+                 ('C', 'CH01', '2024-01-01 08:00')])
+    assert paired_plates(df['Номерной знак'], df['Канал'], df['Время мом. снимка']) == {'A'}
+
+def test_visitor_close_to_a_regular_is_not_merged(csvconv, export_frame):
+    df = export_frame(regular_visits(1) + regular_visits(2) + regular_visits(3)
+                + [(VISITOR, 'CH01', '2024-01-04 10:00'), (VISITOR, 'CH02', '2024-01-04 12:00')])
+    report = csvconv.process_intervals(df, PlateReconciler({}, max_distance=1, min_reads=3))
+    assert totals(report) == {REGULAR: (3, 180), VISITOR: (1, 120)}
+
+def test_unpaired_misread_is_merged(csvconv, export_frame):
+    df = export_frame(regular_visits(1) + regular_visits(2)
+                + [(REGULAR, 'CH01', '2024-01-03 08:00'), (VISITOR, 'CH02', '2024-01-03 09:30')])
+    reconciler = PlateReconciler({}, max_distance=1, min_reads=3)
+    report = csvconv.process_intervals(df, reconciler)
+    assert totals(report) == {REGULAR: (3, 210)}
+    assert reconciler.matches == {VISITOR: REGULAR}
+
+def test_engine_keeps_visitor_apart(tmp_path, export_frame):
+    store = EventStore(str(tmp_path / 'events.db'))
+    df = export_frame(regular_visits(1) + regular_visits(2) + regular_visits(3)
+                + [(VISITOR, 'CH01', '2024-01-04 10:00'), (VISITOR, 'CH02', '2024-01-04 12:00')])
+    store.replace_files('2024-01', [], [df])
+    engine = IntervalEngine(store, PlateReconciler({}, max_distance=1, min_reads=3))
+    engine.update()
+    month = engine.month_totals('2024-01')
+    assert dict(zip(month['plate'], month['visits'])) == {REGULAR: 3, VISITOR: 1}
+    store.close()
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import fake_sheets
+from fake_sheets import FakeSheetsService
+
+SHEETS = {
+    '01.2024': [['Номерной знак', 'Количество проездов'], ['1234AB-1', 3]],
+    '02.2024': [['Номерной знак', 'Количество проездов'], ['1234AB-1', 5]],
+    '03.2024': [['Номерной знак', 'Количество проездов'], ['5678CD-2', 1]],
+}
+
+def methods(service):
+    return [method for method, _ in service.calls]
+
+def test_publish_uses_fixed_number_of_calls(csvconv, tmp_path):
+    service = FakeSheetsService(titles=['01.2024'])
+    publisher = csvconv.SheetsPublisher(service, 'sheet-id', state_file=str(tmp_path / 'published.json'))
+
+    assert sorted(publisher.publish(SHEETS)) == sorted(SHEETS)
+    assert methods(service) == ['spreadsheets.get', 'spreadsheets.batchUpdate',
+                                'values.batchClear', 'values.batchUpdate']
+    assert service.sheets == SHEETS
+
+def test_unchanged_sheets_are_skipped(csvconv, tmp_path):
+    state_file = str(tmp_path / 'published.json')
+    service = FakeSheetsService()
+    csvconv.SheetsPublisher(service, 'sheet-id', state_file=state_file).publish(SHEETS)
+    service.calls.clear()
+
+    # The hashes are read back from the state file by a new run
+    publisher = csvconv.SheetsPublisher(service, 'sheet-id', state_file=state_file)
+    assert publisher.publish(SHEETS) == []
+    assert service.calls == []
+
+    changed = dict(SHEETS, **{'02.2024': [['Номерной знак'], ['9999XX-9']]})
+    assert publisher.publish(changed) == ['02.2024']
+    assert methods(service) == ['spreadsheets.get', 'values.batchClear', 'values.batchUpdate']
+
+def test_failed_publish_is_sent_again(csvconv, tmp_path, monkeypatch):
+    state_file = str(tmp_path / 'published.json')
+    service = FakeSheetsService()
+
+    def fail(self, spreadsheetId, body):
+        raise ConnectionError("quota exceeded")
+    with monkeypatch.context() as patch:
+        patch.setattr(fake_sheets._Values, 'batchUpdate', fail)
+        with pytest.raises(ConnectionError):
+            csvconv.SheetsPublisher(service, 'sheet-id', state_file=state_file).publish(SHEETS)
+
+    publisher = csvconv.SheetsPublisher(service, 'sheet-id', state_file=state_file)
+    assert sorted(publisher.publish(SHEETS)) == sorted(SHEETS)
+    assert service.sheets == SHEETS
+
+def test_dry_run_does_not_save_publish_state(csvconv, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('SHEETS_DRY_RUN', '1')
+    (tmp_path / 'csvbymonth').mkdir()
+    (tmp_path / 'csvbymonth' / 'intervals_2024-01.csv').write_text(
+        'Номерной знак,Количество проездов,Суммарное время (мин),Детали проездов\n1234AB-1,1,90,x\n',
+        encoding='utf-8-sig')
+
+    # The month stays unpublished, so the next real run publishes it
+    assert csvconv.update_sheets_with_intervals() == {'2024-01'}
+    assert not (tmp_path / 'csvbymonth' / 'published.json').exists()
+
+def test_state_file_holds_content_hashes(csvconv, tmp_path):
+    state_file = tmp_path / 'published.json'
+    csvconv.SheetsPublisher(FakeSheetsService(), 'sheet-id', state_file=str(state_file)).publish(SHEETS)
+    assert json.loads(state_file.read_text(encoding='utf-8')) == {
+        name: csvconv.SheetsPublisher.content_hash(values) for name, values in SHEETS.items()}